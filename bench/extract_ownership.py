@@ -0,0 +1,74 @@
+"""Times extracting a release tree with many small files, comparing the old
+extract-then-`chown -R` path against extracting as the owner directly.
+
+Must be run as root, on a Linux host with `sudo`:
+
+    sudo python bench/extract_ownership.py [num_files] [owner] [repeats]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+from tempfile import mkdtemp
+from time import time
+
+
+# (name, shell command) for each path; {artifact}, {dest} and {owner} are filled in
+EXTRACT_PATHS = [
+    ('extract + chown -R',
+     'mkdir -p {dest} && tar -C {dest}/ -xzf {artifact} && chown -R {owner} {dest}'),
+    ('extract as owner',
+     'mkdir -p {dest} && chown {owner} {dest} && '
+     'gzip -dc {artifact} | {as_owner} tar -C {dest}/ -xpf - --no-same-owner'),
+]
+
+
+def build_artifact(work_dir, num_files):
+    """Builds a gzipped tarball of `num_files` small files, 100 per directory."""
+    src = os.path.join(work_dir, 'src')
+    for i in xrange(num_files):
+        subdir = os.path.join(src, 'pkg{}'.format(i // 100))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'f{}.js'.format(i)), 'w') as dest:
+            dest.write('module.exports = {};\n'.format(i))
+
+    artifact = os.path.join(work_dir, 'artifact.tgz')
+    with tarfile.open(artifact, 'w:gz') as tar:
+        tar.add(src, arcname='.')
+    shutil.rmtree(src)
+    return artifact
+
+
+def main(num_files=20000, owner='nobody:nogroup', repeats=3):
+    """Runs each extraction path `repeats` times, and prints the best times."""
+    (user, _, group) = owner.partition(':')
+    as_owner = 'sudo -n -u {} -g {} --'.format(user, group) if group \
+        else 'sudo -n -u {} --'.format(user)
+
+    work_dir = mkdtemp()
+    os.chmod(work_dir, 0o755)
+    try:
+        artifact = build_artifact(work_dir, num_files)
+        print 'Extracting [{}] small files as [{}], best of [{}]:'.format(num_files, owner,
+                                                                          repeats)
+        for (name, command) in EXTRACT_PATHS:
+            timings = []
+            for _ in xrange(repeats):
+                dest = os.path.join(work_dir, 'release')
+                subprocess.check_call(
+                    'sync; (echo 3 > /proc/sys/vm/drop_caches) 2>/dev/null || true', shell=True)
+                start = time()
+                subprocess.check_call(command.format(artifact=artifact, dest=dest, owner=owner,
+                                                     as_owner=as_owner), shell=True)
+                timings.append(time() - start)
+                shutil.rmtree(dest)
+            print '  {:<20} {:>8.3f}s'.format(name, min(timings))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
@@ -0,0 +1,454 @@
+"""Times the real `deploy_rolling` task end to end without touching real
+infrastructure: EC2, ELB, S3 and STS are replaced by an in-process fake
+cloud with configurable API latency, connection draining and health check
+timings, and hosts are either localhost (one loopback address per fake
+instance) or a list of SSH targets such as local containers.
+
+Each fleet size is deployed in a forked process, so fabric's per-run state
+(`runs_once`, connections) starts fresh, and reports the wall-clock deploy
+time, the number of AWS calls by operation, and a per-phase breakdown taken
+from the run's timeline (see `orchalib.timing`).
+
+Localhost targets need an sshd reachable with your key and passwordless
+sudo. Every fake instance then gets its own app basedir under `--root`,
+its own loopback address, and a `sleep` in place of the service restart.
+Staging connects to up to `pool_size` hosts at once (see
+`tasks.DEFAULT_POOL_SIZE`), so keep sshd's `MaxStartups` above it.
+Container targets (`--targets`) need one target per instance, with the
+app's service, users and sudo set up as on a real host.
+
+    python bench/rolling_deploy.py [--sizes 1,10,50,200] [--config extra.yml]
+"""
+
+import argparse
+import fnmatch
+import getpass
+import grp
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep, time
+
+import yaml
+from botocore.exceptions import ClientError
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+BENCH_APP = 'demoapp'
+BENCH_ENV = 'bench'
+BENCH_BUCKET = 'bench-artifacts'
+BENCH_ELB = 'bench-demoapp'
+
+# API page sizes of the real services
+EC2_PAGE_SIZE = 1000
+ELB_PAGE_SIZE = 400
+
+
+class FakeCloud(object):
+    """In-process stand-in for the EC2, ELB, S3 and STS APIs used by deploytool.
+
+    Deregistered instances keep reporting InService for `drain_seconds`, as
+    a classic ELB does while draining, then OutOfService. Like ELB, they are
+    only reported when asked for by id. Registered
+    instances report OutOfService for `healthy_seconds`, then InService.
+    """
+
+    def __init__(self, hosts, artifact, api_latency, drain_seconds, healthy_seconds,
+                 num_other_elbs):
+        self.api_latency = api_latency
+        self.drain_seconds = drain_seconds
+        self.healthy_seconds = healthy_seconds
+        self.lock = Lock()
+
+        self.instances = []
+        for (num, host) in enumerate(hosts):
+            self.instances.append({
+                'InstanceId': 'i-{:08x}'.format(num),
+                'PrivateIpAddress': host,
+                'State': {'Name': 'running'},
+                'Tags': [{'Key': 'Environment', 'Value': BENCH_ENV},
+                         {'Key': 'Apps', 'Value': BENCH_APP},
+                         {'Key': 'Name', 'Value': 'bench-{}'.format(num)}],
+            })
+
+        # the app's ELB, among others that discovery has to scan past
+        self.elb_tags = {BENCH_ELB: {'Environment': BENCH_ENV, 'Apps': BENCH_APP}}
+        for num in xrange(num_other_elbs):
+            self.elb_tags['other-{}'.format(num)] = {'Environment': 'prd',
+                                                     'Apps': 'other{}'.format(num)}
+        # instance id -> ('registered'|'deregistered', since)
+        self.elb_state = {i['InstanceId']: ('registered', 0) for i in self.instances}
+
+        with open(artifact, 'rb') as src:
+            self.artifact = src.read()
+        self.artifact_key = 'demoapp/{}'.format(os.path.basename(artifact))
+        self.artifact_etag = '"{}"'.format(hashlib.md5(self.artifact).hexdigest())
+
+    def sts_get_caller_identity(self):
+        return {'Account': '000000000000'}
+
+    def ec2_describe_instances(self, Filters=(), NextToken=None):
+        matches = []
+        for instance in self.instances:
+            tags = {tag['Key']: tag['Value'] for tag in instance['Tags']}
+            for fltr in Filters:
+                if fltr['Name'] == 'instance-state-name':
+                    value = instance['State']['Name']
+                else:
+                    value = tags.get(fltr['Name'][len('tag:'):])
+                if value is None or not any(fnmatch.fnmatchcase(value, pattern)
+                                            for pattern in fltr['Values']):
+                    break
+            else:
+                matches.append(instance)
+
+        start = int(NextToken or 0)
+        resp = {'Reservations': [{'Instances': [i]}
+                                 for i in matches[start:start + EC2_PAGE_SIZE]]}
+        if start + EC2_PAGE_SIZE < len(matches):
+            resp['NextToken'] = str(start + EC2_PAGE_SIZE)
+        return resp
+
+    def elb_describe_load_balancers(self, Marker=None):
+        names = sorted(self.elb_tags)
+        start = int(Marker or 0)
+        resp = {'LoadBalancerDescriptions': [{'LoadBalancerName': name}
+                                             for name in names[start:start + ELB_PAGE_SIZE]]}
+        if start + ELB_PAGE_SIZE < len(names):
+            resp['NextMarker'] = str(start + ELB_PAGE_SIZE)
+        return resp
+
+    def elb_describe_tags(self, LoadBalancerNames):
+        return {'TagDescriptions': [
+            {'LoadBalancerName': name,
+             'Tags': [{'Key': k, 'Value': v} for (k, v) in self.elb_tags[name].items()]}
+            for name in LoadBalancerNames]}
+
+    def elb_describe_load_balancer_attributes(self, LoadBalancerName):
+        return {'LoadBalancerAttributes': {'ConnectionDraining': {
+            'Enabled': self.drain_seconds > 0,
+            'Timeout': int(self.drain_seconds) + 1,
+        }}}
+
+    def elb_deregister_instances_from_load_balancer(self, LoadBalancerName, Instances):
+        with self.lock:
+            for instance in Instances:
+                self.elb_state[instance['InstanceId']] = ('deregistered', time())
+        return {'Instances': []}
+
+    def elb_register_instances_with_load_balancer(self, LoadBalancerName, Instances):
+        with self.lock:
+            for instance in Instances:
+                self.elb_state[instance['InstanceId']] = ('registered', time())
+        return {'Instances': Instances}
+
+    def elb_describe_instance_health(self, LoadBalancerName, Instances=None):
+        # like ELB, a listing of the whole ELB leaves out instances being deregistered,
+        # which are only reported (as still in service) when asked for by id
+        states = []
+        with self.lock:
+            if Instances is None:
+                instance_ids = [i for (i, (state, _)) in sorted(self.elb_state.items())
+                                if state == 'registered']
+            else:
+                instance_ids = [instance['InstanceId'] for instance in Instances]
+            for instance_id in instance_ids:
+                if instance_id not in self.elb_state:
+                    raise ClientError({'Error': {'Code': 'InvalidInstance'}},
+                                      'DescribeInstanceHealth')
+                (state, since) = self.elb_state[instance_id]
+                elapsed = time() - since
+                if state == 'deregistered':
+                    states.append((instance_id, 'InService' if elapsed < self.drain_seconds
+                                   else 'OutOfService'))
+                elif elapsed < self.healthy_seconds:
+                    states.append((instance_id, 'OutOfService'))
+                else:
+                    states.append((instance_id, 'InService'))
+        return {'InstanceStates': [{'InstanceId': i, 'State': s} for (i, s) in states]}
+
+    def s3_head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.artifact), 'ETag': self.artifact_etag}
+
+    def s3_get_object(self, Bucket, Key, IfMatch=None, Range=None):
+        if IfMatch is not None and IfMatch != self.artifact_etag:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        body = self.artifact
+        if Range is not None:
+            (start, end) = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+        return {'ContentLength': len(body), 'ETag': self.artifact_etag,
+                'Body': io.BytesIO(body)}
+
+
+class FakeEvents(object):
+    """The part of botocore's event system that `timing.instrument_client` uses."""
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler):
+        self.handlers.setdefault(event_name, []).append(handler)
+
+    def emit(self, event_name, **kwargs):
+        for handler in self.handlers.get(event_name, []):
+            handler(**kwargs)
+
+
+class FakeOperationModel(object):
+    """The part of a botocore operation model that event handlers read."""
+
+    def __init__(self, service, name):
+        self.name = name
+        self.service_model = type('ServiceModel', (object,), {'service_name': service})
+
+
+class FakePaginator(object):
+    """Pages through a fake operation by its NextToken or NextMarker."""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **params):
+        while True:
+            page = self.operation(**params)
+            yield page
+            if page.get('NextToken'):
+                params['NextToken'] = page['NextToken']
+            elif page.get('NextMarker'):
+                params['Marker'] = page['NextMarker']
+            else:
+                return
+
+
+class FakeClient(object):
+    """A boto3 client whose calls are served by a FakeCloud, after `api_latency`."""
+
+    def __init__(self, cloud, service):
+        self.cloud = cloud
+        self.service = service
+        self.meta = type('ClientMeta', (object,), {'events': FakeEvents()})()
+
+    def get_paginator(self, name):
+        return FakePaginator(getattr(self, name))
+
+    def __getattr__(self, name):
+        handler = getattr(self.cloud, '{}_{}'.format(self.service, name))
+        operation = ''.join(word.capitalize() for word in name.split('_'))
+
+        def call(**params):
+            model = FakeOperationModel(self.service, operation)
+            context = {}
+            self.meta.events.emit('before-call', model=model, params=params, context=context)
+            sleep(self.cloud.api_latency)
+            resp = handler(**params)
+            self.meta.events.emit('after-call', model=model, parsed=resp, context=context)
+            return resp
+        return call
+
+
+class FakeSession(object):
+    """A boto3 session handing out FakeClients."""
+
+    region_name = 'bench-1'
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def client(self, service, region_name=None, config=None):
+        return FakeClient(self.cloud, service)
+
+
+def build_artifact(work_dir, num_files, file_size):
+    """Builds a gzipped release tarball with a version.txt and `num_files` files."""
+    src = os.path.join(work_dir, 'src')
+    os.makedirs(src)
+    with open(os.path.join(src, 'version.txt'), 'w') as dest:
+        dest.write('bench-{}\n'.format(int(time())))
+    for i in xrange(num_files):
+        subdir = os.path.join(src, 'pkg{}'.format(i // 100))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        with open(os.path.join(subdir, 'f{}'.format(i)), 'wb') as dest:
+            dest.write(os.urandom(file_size))
+
+    artifact = os.path.join(work_dir, 'demoapp-bench.tar.gz')
+    with tarfile.open(artifact, 'w:gz') as tar:
+        tar.add(src, arcname='.')
+    shutil.rmtree(src)
+    return artifact
+
+
+def get_localhost_targets(size):
+    """Returns a distinct loopback address for each of `size` fake instances."""
+    return ['127.0.{}.{}'.format(num // 250, num % 250 + 1) for num in xrange(size)]
+
+
+def isolate_localhost_targets(root, restart_seconds):
+    """Makes fake instances that share localhost look like separate hosts: each
+    gets its own app basedir and temp dir, keyed by its address, and restarts
+    are a sleep. Must be called before the fabfile is imported."""
+    import orchalib
+    from fabric.api import env, sudo
+
+    orchalib.DEFAULT_OWNER = '{}:{}'.format(getpass.getuser(),
+                                            grp.getgrgid(os.getgid()).gr_name)
+    orchalib.get_app_basedir = lambda app: '{}/{}/apps/{}'.format(root, env.host_string, app)
+    orchalib.get_temp_dir = lambda app: '{}/{}/tmp/{}'.format(root, env.host_string, app)
+
+    from orchalib import tasks, timing
+
+    @timing.timed('restart')
+    def service_restart(appname):
+        sudo('sleep {}'.format(restart_seconds))
+    tasks.service_restart = service_restart
+
+
+def run_deploy(args, cloud, size, localhost):
+    """Runs `deploy_rolling` against the fake cloud in this process."""
+    from orchalib import aws
+    aws.get_session = lambda: FakeSession(cloud)
+    if localhost:
+        isolate_localhost_targets(os.path.join(args.root, str(size)), args.restart_seconds)
+
+    import fabfile
+    from fabric.api import execute
+
+    execute(fabfile.deploy_rolling, BENCH_APP, BENCH_ENV,
+            artifact_uri='s3://{}/{}'.format(BENCH_BUCKET, cloud.artifact_key),
+            max_unavailable=args.max_unavailable, stage=args.stage)
+
+
+def write_config(args, work_dir):
+    """Writes the `config.yml` the fabfile reads, from `--config` plus a timeline."""
+    cfg = {'env': {'user': getpass.getuser(), 'disable_known_hosts': True,
+                   'abort_on_prompts': True}}
+    if args.config:
+        with open(args.config, 'r') as extra:
+            for (section, values) in (yaml.safe_load(extra) or {}).items():
+                if isinstance(values, dict) and isinstance(cfg.get(section), dict):
+                    cfg[section].update(values)
+                else:
+                    cfg[section] = values
+    cfg['timeline'] = {'dir': os.path.join(work_dir, 'timelines')}
+
+    with open(os.path.join(work_dir, 'config.yml'), 'w') as dest:
+        yaml.safe_dump(cfg, dest, default_flow_style=False)
+
+
+def bench_fleet(args, artifact, size):
+    """Deploys to a fleet of `size` fake instances in a forked process.
+
+    Returns:
+        a dict of the fleet size, wall-clock time, exit status, AWS call
+        counts and per-phase summary
+    """
+    localhost = not args.targets
+    hosts = get_localhost_targets(size) if localhost else args.targets.split(',')[:size]
+    if len(hosts) < size:
+        raise Exception('Need [{}] targets, but only [{}] given!'.format(size, len(hosts)))
+
+    cloud = FakeCloud(hosts, artifact, args.api_latency_ms / 1000.0, args.drain_seconds,
+                      args.healthy_seconds, args.other_elbs)
+    work_dir = mkdtemp(prefix='deploybench-{}-'.format(size))
+    write_config(args, work_dir)
+    log_file = os.path.join(work_dir, 'deploy.log')
+
+    start = time()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.chdir(work_dir)
+            log = os.open(log_file, os.O_WRONLY | os.O_CREAT, 0o644)
+            os.dup2(log, 1)
+            os.dup2(log, 2)
+            run_deploy(args, cloud, size, localhost)
+            status = 0
+        except BaseException as err:
+            print 'Deploy failed: {!r}'.format(err)
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+    (_, status) = os.waitpid(pid, 0)
+    elapsed = time() - start
+
+    result = {'size': size, 'wall': elapsed, 'status': status >> 8, 'log': log_file,
+              'aws_calls': {}, 'phases': []}
+    timelines = os.path.join(work_dir, 'timelines')
+    runs = sorted(name for name in os.listdir(timelines) if name.endswith('.json')) \
+        if os.path.isdir(timelines) else []
+    if runs:
+        with open(os.path.join(timelines, runs[-1]), 'r') as src:
+            timeline = json.load(src)
+        for row in timeline['summary']:
+            if row['phase'].startswith('aws:'):
+                result['aws_calls'][row['phase'][len('aws:'):]] = row['count']
+            else:
+                result['phases'].append(row)
+    return result
+
+
+def print_result(result):
+    """Prints one fleet size's wall time, AWS calls and phase breakdown."""
+    print '== [{size}] hosts: [{wall:.1f}] seconds, [{calls}] AWS calls{failed}'.format(
+        calls=sum(result['aws_calls'].values()),
+        failed=' (FAILED, see {})'.format(result['log']) if result['status'] else '',
+        **result)
+    for (operation, count) in sorted(result['aws_calls'].items()):
+        print '   {:<50} {:>6}'.format(operation, count)
+    print '   {:<20} {:>6} {:>9} {:>8} {:>8}'.format('phase', 'count', 'total', 'p50', 'p95')
+    for row in result['phases']:
+        print '   {phase:<20} {count:>6} {total:>8.2f}s {p50:>7.2f}s {p95:>7.2f}s'.format(**row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1,10,50,200',
+                        help='comma-separated fleet sizes to deploy to')
+    parser.add_argument('--targets', default=None,
+                        help='comma-separated SSH targets, one per instance '
+                             '(default=loopback addresses on localhost)')
+    parser.add_argument('--root', default='/tmp/deploybench',
+                        help='where localhost targets keep their app dirs')
+    parser.add_argument('--config', default=None,
+                        help='extra config.yml sections to deploy with, i.e. ssh_multiplexing')
+    parser.add_argument('--max-unavailable', default='25%')
+    parser.add_argument('--stage', default='upload', choices=('upload', 'extract', 'none'))
+    parser.add_argument('--api-latency-ms', type=float, default=50)
+    parser.add_argument('--drain-seconds', type=float, default=3)
+    parser.add_argument('--healthy-seconds', type=float, default=5)
+    parser.add_argument('--restart-seconds', type=float, default=1)
+    parser.add_argument('--other-elbs', type=int, default=100,
+                        help='unrelated ELBs that discovery has to scan past')
+    parser.add_argument('--artifact-files', type=int, default=1000)
+    parser.add_argument('--artifact-file-size', type=int, default=4096)
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    build_dir = mkdtemp(prefix='deploybench-artifact-')
+    try:
+        artifact = build_artifact(build_dir, args.artifact_files, args.artifact_file_size)
+        print 'Artifact: [{}] files, [{}] bytes.'.format(args.artifact_files,
+                                                         os.path.getsize(artifact))
+        results = []
+        for size in [int(size) for size in args.sizes.split(',')]:
+            results.append(bench_fleet(args, artifact, size))
+            print_result(results[-1])
+    finally:
+        shutil.rmtree(build_dir)
+
+    if args.json:
+        with open(args.json, 'w') as dest:
+            json.dump(results, dest, indent=2)
+
+
+if __name__ == '__main__':
+    main()
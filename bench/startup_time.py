@@ -0,0 +1,90 @@
+"""Checks how long loading the fabfile takes, which every task (and `fab -l`)
+pays before doing anything, against a budget.
+
+Each measurement is a fresh interpreter. Fabric (and paramiko) have to be
+imported by any fabfile, so they're timed on their own first, and the
+budget applies to what deploytool adds on top. The check also fails if
+loading the fabfile imports any of the dependencies that are meant to be
+imported on first use, or any recipe.
+
+    python bench/startup_time.py [--max-ms 50] [--repeats 10]
+
+Exits non-zero if the budget is exceeded.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# budget in ms for deploytool's own share of the fabfile's load time
+MAX_MS = 50
+
+# modules that loading the fabfile must not import
+LAZY_MODULES = ['boto3', 'botocore', 'requests', 'yaml']
+
+# timed in a fresh interpreter; prints the import time, and the lazy modules
+# and recipes loaded
+IMPORT_SCRIPT = '''
+import json, sys
+from time import time
+start = time()
+{imports}
+elapsed = time() - start
+recipes = [m for m in sys.modules if m.startswith('recipes.') and sys.modules[m]]
+print json.dumps({{'ms': elapsed * 1000,
+                  'loaded': [m for m in {lazy!r} if m in sys.modules],
+                  'recipes': recipes}})
+'''
+
+
+def time_import(imports, repeats):
+    """Returns the best time in ms of `imports` over `repeats` fresh interpreters,
+    the lazy modules they loaded, and the recipes they loaded."""
+    script = IMPORT_SCRIPT.format(imports=imports, lazy=LAZY_MODULES)
+    best = None
+    for _ in xrange(repeats):
+        out = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT_DIR)
+        result = json.loads(out.strip().splitlines()[-1])
+        best = result['ms'] if best is None else min(best, result['ms'])
+    return (best, result['loaded'], result['recipes'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--max-ms', type=float, default=MAX_MS,
+                        help="budget for deploytool's own share of the fabfile's load time")
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    (fabric_ms, _, _) = time_import('import fabric.api, paramiko', args.repeats)
+    (fabfile_ms, loaded, recipes) = time_import('import fabfile', args.repeats)
+    (recipe_ms, _, recipe_recipes) = time_import(
+        'import fabfile\nfrom orchalib import registry\nregistry.load_recipe("demoapp")',
+        args.repeats)
+    own_ms = fabfile_ms - fabric_ms
+
+    print 'fabric + paramiko:        {:>8.1f} ms'.format(fabric_ms)
+    print 'fabfile:                  {:>8.1f} ms'.format(fabfile_ms)
+    print 'fabfile + one recipe:     {:>8.1f} ms'.format(recipe_ms)
+    print "deploytool's own share:   {:>8.1f} ms (budget {:.0f} ms)".format(own_ms, args.max_ms)
+
+    failed = False
+    if own_ms > args.max_ms:
+        print 'FAIL: loading the fabfile is over budget.'
+        failed = True
+    if loaded or recipes:
+        print 'FAIL: loading the fabfile imported {}.'.format(loaded + recipes)
+        failed = True
+    if recipe_recipes != ['recipes.demoapp']:
+        print 'FAIL: loading one recipe imported {}.'.format(recipe_recipes)
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,49 @@
 """Fabfile contains main deployment task"""
 
-from pkgutil import iter_modules
-import yaml
+from functools import wraps
+import json
+from multiprocessing import Process
+import re
 
-from fabric.api import env, execute, task
+from fabric.api import env, execute, hide, settings, task
 from fabric.decorators import runs_once, hosts
 
-import recipes
+from orchalib import artifacts
 from orchalib import aws
+from orchalib import connections
+from orchalib import fanout
+from orchalib import read_json_config
+from orchalib import probes
+from orchalib import registry
+from orchalib import tasks
+from orchalib import timing
 
 
 DEBUG = False
 
+# default location of the on-disk inventory cache, when enabled in `config.yml`
+INVENTORY_CACHE_DIR = '~/.deploytool/cache'
+
+# default location and size of the local artifact cache, when enabled in `config.yml`
+ARTIFACT_CACHE_DIR = '~/.deploytool/artifacts'
+ARTIFACT_CACHE_SIZE_MB = 10240
+
+# default location of SSH ControlMaster sockets, when multiplexing is enabled in `config.yml`
+SSH_CONTROL_DIR = '~/.deploytool/ssh'
+
+# default number of releases each host keeps, when the release store is enabled in `config.yml`
+RELEASE_STORE_RETENTION = 5
+
+# default location of run timelines, when enabled in `config.yml`
+TIMELINE_DIR = '~/.deploytool/timelines'
+# max length of each task arg in the name of a run's timeline, which keeps the end of it
+RUN_NAME_ARG_LEN = 40
+
 
 def __read_config():
     ''' Loads deploytool's config options from a `config.yml`, if specified. '''
+    import yaml
+
     cfg_file = open('config.yml', 'r')
     cfg = yaml.load(cfg_file.read())
 
@@ -23,26 +52,283 @@ def __read_config():
         for (key, val) in cfg['env'].items():
             env[key] = val
 
+    if cfg.has_key('ssh_multiplexing'):
+        # share bastion connections across waves, parallel workers and runs
+        mux_cfg = cfg['ssh_multiplexing'] or {}
+        connections.enable_multiplexing(mux_cfg.get('dir', SSH_CONTROL_DIR),
+                                        mux_cfg.get('persist', '15m'))
+        env['prewarm_connections'] = mux_cfg.get('prewarm', True)
+
+    if cfg.has_key('aws') and cfg['aws'].has_key('max_pool_connections'):
+        # size boto3's HTTP connection pools for parallel deploys
+        aws.set_max_pool_connections(cfg['aws']['max_pool_connections'])
+
+    if cfg.has_key('inventory_cache'):
+        # share EC2/ELB discovery results across fab runs
+        cache_cfg = cfg['inventory_cache'] or {}
+        aws.enable_inventory_cache(cache_cfg.get('dir', INVENTORY_CACHE_DIR),
+                                   cache_cfg.get('ttl', 300))
+
+    if cfg.has_key('artifact_cache'):
+        # skip S3 downloads for artifacts already fetched by a previous run
+        cache_cfg = cfg['artifact_cache'] or {}
+        artifacts.enable_artifact_cache(cache_cfg.get('dir', ARTIFACT_CACHE_DIR),
+                                        cache_cfg.get('max_size_mb', ARTIFACT_CACHE_SIZE_MB))
+
+    if cfg.has_key('release_store'):
+        # keep releases on hosts by artifact checksum, so redeploying one is a symlink switch
+        store_cfg = cfg['release_store'] or {}
+        tasks.enable_release_store(store_cfg.get('retention', RELEASE_STORE_RETENTION))
+
+    if cfg.has_key('timeline'):
+        # record per-phase timings of rolling runs as JSON timelines
+        env['timeline_dir'] = (cfg['timeline'] or {}).get('dir', TIMELINE_DIR)
+
     if DEBUG:
         print env
 
 
-def __get_instances_for_app(app_name, environment):
+def __get_run_name(task_name, args):
+    ''' Returns a name for a run of the task with `args` that's safe to use in a filename,
+    i.e. with a manifest's path or S3 URL (or raw JSON) cut down to the end of it. '''
+    slugs = [re.sub(r'[^A-Za-z0-9_.-]+', '_', str(arg))[-RUN_NAME_ARG_LEN:].strip('_.')
+             for arg in args]
+    return '-'.join([task_name] + [slug for slug in slugs if slug])
+
+
+def __timeline(func):
+    ''' Decorates a rolling task to load the config and, if a timeline is configured,
+    record the run's phase timings and write them out as a JSON timeline when it ends. '''
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        __read_config()
+        if not env.get('timeline_dir'):
+            return func(*args, **kwargs)
+
+        timing.start_run(__get_run_name(func.__name__, args[:2]), env['timeline_dir'])
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timing.finish_run()
+    return decorated
+
+
+def __is_true(value):
+    ''' Returns boolean for a task argument, which fab passes as a string. '''
+    return str(value).lower() in ('1', 'true', 'yes', 'y')
+
+
+def __print_inventory_cache_stats():
+    ''' Prints the inventory cache hit/miss counts, if the cache is enabled. '''
+    if aws.is_inventory_cache_enabled():
+        stats = aws.get_inventory_cache_stats()
+        print 'Inventory cache: {hits} hits, {misses} misses, {refreshes} refreshes'.format(**stats)
+
+
+def __prewarm_connections(instances):
+    ''' Opens SSH connections to `instances` ahead of time, if configured to. '''
+    if env.get('prewarm_connections'):
+        connections.prewarm([i.instance_ip for i in instances])
+
+
+def __print_connection_stats():
+    ''' Prints the SSH connection handshake/reuse counts, if multiplexing is enabled. '''
+    if connections.is_multiplexing_enabled():
+        stats = connections.get_pool_stats()
+        print 'SSH connections: {handshakes} handshakes, {reused} reused'.format(**stats)
+
+
+def __get_instances_for_app(app_name, environment, refresh=False):
     ''' Returns a list of EC2 instances that have an `Apps` tag containing `app_name`. '''
-    instances = []
-    for i in aws.get_instances(environment=environment):
-        if i.has_app(app_name):
-            instances.append(i)
-    return instances
+    return aws.get_instances(environment=environment, app=app_name,
+                             refresh=refresh).for_app(app_name)
+
+
+def __get_batch_size(max_unavailable, num_instances):
+    ''' Returns how many instances may be out of service at once. `max_unavailable` is
+    either an absolute count (i.e. "5") or a percentage of the fleet (i.e. "25%"). '''
+    if max_unavailable is None:
+        return 1
+
+    value = str(max_unavailable).strip()
+    try:
+        if value.endswith('%'):
+            batch_size = int(num_instances * float(value[:-1]) / 100)
+        else:
+            batch_size = int(value)
+    except ValueError:
+        print 'ERROR: invalid max_unavailable value [{}]'.format(max_unavailable)
+        exit(1)
+
+    # always make progress, but never take out more than the whole fleet
+    return max(1, min(batch_size, num_instances))
+
+
+def __get_waves(instances, max_unavailable):
+    ''' Splits `instances` into waves of at most `max_unavailable` instances. '''
+    batch_size = __get_batch_size(max_unavailable, len(instances))
+    return [instances[i:i + batch_size] for i in xrange(0, len(instances), batch_size)]
+
+
+def __get_health_check_url(recipe):
+    ''' Returns the URL the recipe's instances are probed at before going back into
+    their ELBs, or None if the recipe doesn't declare one. '''
+    return getattr(recipe, 'HEALTH_CHECK_URL', None)
+
+
+def __rolling_execute(instances, elbs, max_unavailable, health_check_url, func,
+                      *args, **kwargs):
+    ''' Runs `func` on `instances` in waves, removing each wave from the ELBs beforehand
+    and re-registering it afterwards. Hosts within a wave are handled in parallel. With a
+    `health_check_url`, a wave is only re-registered once every host in it answers. '''
+    for (num, wave) in enumerate(__get_waves(instances, max_unavailable)):
+        instance_ids = [i.instance_id for i in wave]
+
+        with timing.span('wave', host='localhost', wave=num, size=len(wave)):
+            aws.remove_instances_from_elbs(elbs, instance_ids)
+
+            with settings(parallel=len(wave) > 1, pool_size=tasks.get_pool_size(len(wave))):
+                execute(func, hosts=[i.instance_ip for i in wave], *args, **kwargs)
+
+            if health_check_url and probes.wait_until_ready(wave, health_check_url):
+                raise Exception("Instance Not Ready")
+
+            failed = [r for r in aws.add_instances_to_elbs(elbs, instance_ids) if not r.healthy]
+        if failed:
+            raise Exception("Instance Not Healthy")
+
+
+def __get_elb_map(instances, app_elbs):
+    ''' Returns a dict of ELB name -> ids of the `instances` in it, given a dict of app ->
+    ELB names, so that each instance only leaves and rejoins the ELBs of the apps it hosts. '''
+    elb_map = {}
+    for instance in instances:
+        for app in sorted(instance.apps.intersection(app_elbs)):
+            for name in app_elbs[app]:
+                instance_ids = elb_map.setdefault(name, [])
+                if instance.instance_id not in instance_ids:
+                    instance_ids.append(instance.instance_id)
+    return elb_map
+
+
+def __deploy_apps(deploys):
+    ''' Runs the deploy of each app the current host is listed for in `deploys`, a dict of
+    host -> list of (recipe, deploy kwargs), one app after the other. '''
+    for (recipe, deploy_kwargs) in deploys[env.host_string]:
+        recipe.deploy(**deploy_kwargs)
+
+
+def __rolling_execute_apps(instances, app_elbs, max_unavailable, app_deploys):
+    ''' Deploys several apps to `instances` in waves, like `__rolling_execute`, with a single
+    drain/register cycle per instance for all of the apps it hosts. `app_elbs` is a dict of
+    app -> ELB names, and `app_deploys` a dict of app -> (recipe, deploy kwargs). '''
+    for (num, wave) in enumerate(__get_waves(instances, max_unavailable)):
+        elb_map = __get_elb_map(wave, app_elbs)
+        deploys = {}
+        for instance in wave:
+            deploys[instance.instance_ip] = [app_deploys[app] for app in
+                                             sorted(instance.apps.intersection(app_deploys))]
+
+        with timing.span('wave', host='localhost', wave=num, size=len(wave)):
+            aws.remove_instances_from_elb_map(elb_map)
+
+            with settings(parallel=len(wave) > 1, pool_size=tasks.get_pool_size(len(wave))):
+                execute(__deploy_apps, deploys, hosts=[i.instance_ip for i in wave])
+
+            for (app, (recipe, _)) in sorted(app_deploys.items()):
+                health_check_url = __get_health_check_url(recipe)
+                app_wave = [i for i in wave if i.has_app(app)]
+                if health_check_url and app_wave and \
+                        probes.wait_until_ready(app_wave, health_check_url):
+                    raise Exception("Instance Not Ready")
+
+            failed = [r for r in aws.add_instances_to_elb_map(elb_map) if not r.healthy]
+        if failed:
+            raise Exception("Instance Not Healthy")
+
+
+def __group_co_hosted_apps(inventory, apps):
+    ''' Splits `apps` into groups that share no instances, as a list of (apps, instances).
+    Apps that are both on any one instance end up in the same group. '''
+    groups = []
+    for app in apps:
+        group_apps = set([app])
+        group_ids = set(i.instance_id for i in inventory.for_app(app))
+        for (other_apps, other_ids) in list(groups):
+            if other_ids & group_ids:
+                groups.remove((other_apps, other_ids))
+                group_apps |= other_apps
+                group_ids |= other_ids
+        groups.append((group_apps, group_ids))
+
+    return [(sorted(group_apps), [i for i in inventory if i.instance_id in group_ids])
+            for (group_apps, group_ids) in groups]
+
+
+def __group_by_shared_elbs(groups, app_elbs):
+    ''' Splits `groups` of co-hosted apps, a list of (apps, instances), into lanes of groups
+    that share no ELBs, as a list of lists of groups. Groups behind any one ELB end up in
+    the same lane, so that they can be rolled one after the other. '''
+    lanes = []
+    for group in groups:
+        lane_groups = [group]
+        lane_elbs = set(elb for app in group[0] for elb in app_elbs[app])
+        for (other_groups, other_elbs) in list(lanes):
+            if other_elbs & lane_elbs:
+                lanes.remove((other_groups, other_elbs))
+                lane_groups = other_groups + lane_groups
+                lane_elbs |= other_elbs
+        lanes.append((lane_groups, lane_elbs))
+
+    return [lane_groups for (lane_groups, _) in lanes]
+
+
+def __rolling_execute_groups(groups, app_elbs, max_unavailable, app_deploys):
+    ''' Rolls each of `groups` of co-hosted apps through its waves, one group after the
+    other, so that the groups never have instances out of the same ELB at once. '''
+    for (group_apps, instances) in groups:
+        __rolling_execute_apps(instances, app_elbs, max_unavailable,
+                               {app: app_deploys[app] for app in group_apps})
+
+
+def __run_in_parallel(jobs):
+    ''' Runs each of `jobs`, a list of (name, func, args), in a forked process at once, like
+    fabric's parallel workers, and raises an Exception if any of them failed. '''
+    if len(jobs) == 1:
+        (_, func, args) = jobs[0]
+        return func(*args)
+
+    processes = [(name, Process(target=func, args=args)) for (name, func, args) in jobs]
+    for (_, process) in processes:
+        process.start()
+    for (_, process) in processes:
+        process.join()
+
+    failed = [name for (name, process) in processes if process.exitcode != 0]
+    if failed:
+        raise Exception("Deployment failed for {}".format(', '.join(failed)))
+
+
+def __stage_artifact(app_name, recipe, artifact_uri, instances, stage):
+    ''' Pushes the fetched artifact to every instance in parallel, before any of them are
+    drained, if the recipe supports it. Returns boolean indicating it was staged. '''
+    if not artifact_uri or stage == 'none' or not hasattr(recipe, 'stage'):
+        return False
+
+    if tasks.get_artifact_transfer() == 'fanout':
+        with timing.span('distribute', host='localhost', app=app_name):
+            fanout.distribute_artifact(app_name, artifact_uri,
+                                       [i.instance_ip for i in instances])
+    with settings(parallel=True, pool_size=tasks.get_pool_size()), \
+            timing.span('stage', host='localhost', app=app_name):
+        execute(recipe.stage, uri=artifact_uri, extract=(stage == 'extract'),
+                hosts=[i.instance_ip for i in instances])
+    return True
 
 
 def __load_recipe(app_name, cfg=None):
     ''' Returns the `recipe` module for the given `app_name`. '''
-    recipe = None
-    for (mod_loader, name, ispkg) in iter_modules(recipes.__path__, 'recipes.'):
-        if name == 'recipes.' + app_name and not ispkg:
-            loader = mod_loader.find_module(name, mod_loader.path)
-            recipe = loader.load_module(name)
+    recipe = registry.load_recipe(app_name)
 
     if not recipe:
         print 'ERROR: no recipe found for [{}]'.format(app_name)
@@ -58,24 +344,85 @@ def __load_recipe(app_name, cfg=None):
     return recipe
 
 
+def __get_version_report(app_name, environment, instances, versions):
+    ''' Returns a dict of the instances grouped by deployed version, most common first.
+    Hosts without a version file, or that couldn't be reached, are grouped too. '''
+    groups = {}
+    for i in instances:
+        version = versions.get(i.instance_ip)
+        if version is None:
+            version = '<missing>'
+        elif not isinstance(version, basestring):
+            version = '<error>'
+        groups.setdefault(version, []).append({'instance_id': i.instance_id,
+                                               'ip': i.instance_ip})
+
+    groups = sorted(groups.items(), key=lambda (version, hosts): (-len(hosts), version))
+    return {
+        'app': app_name,
+        'environment': environment,
+        'majority': groups[0][0],
+        'drift': len(groups) > 1,
+        'versions': [{'version': version, 'count': len(hosts), 'hosts': hosts}
+                     for (version, hosts) in groups],
+    }
+
+
+def __print_version_table(report):
+    ''' Prints a version report, listing the hosts that aren't on the majority version. '''
+    width = max(len('VERSION'), *[len(group['version']) for group in report['versions']])
+    print '{:<{width}}  {:>5}'.format('VERSION', 'HOSTS', width=width)
+    for group in report['versions']:
+        print '{:<{width}}  {:>5}'.format(group['version'], group['count'], width=width)
+        if group['version'] != report['majority']:
+            for host in group['hosts']:
+                print '{:<{width}}    {instance_id} ({ip})'.format('', width=width, **host)
+    if report['drift']:
+        print 'WARNING: [{}] versions deployed!'.format(len(report['versions']))
+
+
 @task
-def show_version(app_name, environment):
-    """Prints out the deployed version of an app.
+def show_version(app_name, environment, refresh=False, output='table'):
+    """Prints out the deployed version of an app, grouped by version across the fleet.
 
     Args:
         app_name:    The name of the application.
         environment: The environment for the specified app.
+
+    KW-Args:
+        refresh:     Re-discover the inventory instead of using the cache. (default=False)
+        output:      One of table|json. For JSON only, run with `--hide=status`. (default=table)
     """
     __read_config()
+    if output not in ('table', 'json'):
+        raise Exception("The `output` option must be one of table|json!")
+    verbose = output == 'table'
     recipe = __load_recipe(app_name)
 
-    instances = __get_instances_for_app(app_name, environment)
+    instances = __get_instances_for_app(app_name, environment, __is_true(refresh))
+    if verbose:
+        __print_inventory_cache_stats()
     if not instances:
         print 'ERROR: no instances found!'
         exit(1)
 
-    for i in instances:
-        execute(recipe.print_app_version, hosts=[i.instance_ip])
+    __prewarm_connections(instances)
+
+    ## read the version file on every instance at once
+    if hasattr(recipe, 'get_app_version'):
+        (func, args) = (recipe.get_app_version, [])
+    else:
+        (func, args) = (tasks.get_app_version, [app_name])
+    with settings(hide('running', 'stdout'), parallel=True, pool_size=tasks.get_pool_size(),
+                  warn_only=True, skip_bad_hosts=True):
+        versions = execute(func, hosts=[i.instance_ip for i in instances], *args)
+
+    report = __get_version_report(app_name, environment, instances, versions)
+    if verbose:
+        __print_version_table(report)
+        __print_connection_stats()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
 
 
 @task
@@ -98,81 +445,273 @@ def show_artifacts(app_name, num_weeks=2):
 @task
 @runs_once
 @hosts('127.0.0.1')
-def restart_rolling(app_name, environment):
-    """Performs a cluster-wide rolling restart of the app.
+def show_recipes():
+    """Prints the names of the apps that have a deploy recipe."""
+    for name in registry.list_recipes():
+        print name
 
-    Args:
-        app_name:    The name of the app to restart.
-        environment: The environment for the specified app.
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+def show_artifact_cache():
+    """Prints a listing of the artifacts in the local artifact cache, most recently used first."""
+    __read_config()
+    for entry in artifacts.list_cached_artifacts():
+        print '{}  {:>12}  {}'.format(entry['etag'], entry['size'], entry['uri'])
+
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+def prune_artifact_cache(max_size_mb=None):
+    """Evicts least recently used artifacts from the local artifact cache.
+
+    KW-Args:
+        max_size_mb: The size in MB to prune the cache down to. (default=configured size)
     """
     __read_config()
+    max_bytes = None
+    if max_size_mb is not None:
+        max_bytes = int(max_size_mb) * 1024 * 1024
+    for entry in artifacts.prune_artifact_cache(max_bytes):
+        print 'Evicted {}'.format(entry['uri'] or entry['path'])
 
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+@__timeline
+def restart_rolling(app_name, environment, max_unavailable=None, refresh=False):
+    """Performs a cluster-wide rolling restart of the app.
+
+    Args:
+        app_name:        The name of the app to restart.
+        environment:     The environment for the specified app.
+
+    KW-Args:
+        max_unavailable: The number (i.e. 5) or percentage (i.e. 25%) of instances
+                         to restart in parallel per wave. (default=1)
+        refresh:         Re-discover the inventory instead of using the cache. (default=False)
+    """
     recipe = __load_recipe(app_name)
 
-    ## get list of ELBs to bleed instances out-of/into
-    elbs = aws.get_elbs(app_name, environment)
+    with timing.span('discovery', host='localhost'):
+        ## get list of ELBs to bleed instances out-of/into
+        elbs = aws.get_elbs(app_name, environment, refresh=__is_true(refresh))
+
+        ## get list of instances to bleed out-of/into the ELBs
+        instances = __get_instances_for_app(app_name, environment, __is_true(refresh))
     if not elbs:
         print 'WARNING: No ELBs found for app. Continuing with rude restart...'
-
-    ## get list of instances to bleed out-of/into the ELBs
-    instances = __get_instances_for_app(app_name, environment)
+    __print_inventory_cache_stats()
     if not instances:
         print 'ERROR: no target instances found for service restart!'
         exit(1)
+    __prewarm_connections(instances)
 
-    ## iterate over instances, removing from ELBs, restarting, then re-registering into ELBs
-    for i in instances:
-        for elb_name in elbs:
-            aws.remove_instance_from_elb(elb_name, i.instance_id)
-
-        execute(recipe.service_restart, hosts=[i.instance_ip])
-
-        for elb_name in elbs:
-            aws.add_instance_to_elb(elb_name, i.instance_id)
+    ## iterate over waves of instances, removing from ELBs, restarting, then re-registering
+    __rolling_execute(instances, elbs, max_unavailable, __get_health_check_url(recipe),
+                      recipe.service_restart)
+    __print_connection_stats()
 
 
 @task
 @runs_once
 @hosts('127.0.0.1')
-def deploy_rolling(app_name, environment, artifact_uri=None, cfg=None):
+@__timeline
+def deploy_rolling(app_name, environment, artifact_uri=None, cfg=None, max_unavailable=None,
+                   stage='upload', refresh=False):
     """Does a rolling deployment of the given app.
 
     Args:
-        app_name:     The name of the app/recipe to deploy.
-        environment:  The environment (i.e. dev|stg|prd) to deploy to.
+        app_name:        The name of the app/recipe to deploy.
+        environment:     The environment (i.e. dev|stg|prd) to deploy to.
 
     KW-Args:
-        artifact_uri: An S3 URL for the artifact to deploy (used by some recipes).
-        cfg:         A custom JSON config to pass to the deploy recipe (either
-                     a filename or raw json string).
+        artifact_uri:    An S3 URL for the artifact to deploy (used by some recipes).
+        cfg:             A custom JSON config to pass to the deploy recipe (either
+                         a filename or raw json string).
+        max_unavailable: The number (i.e. 5) or percentage (i.e. 25%) of instances
+                         to deploy to in parallel per wave. (default=1)
+        stage:           How to pre-stage the artifact on every instance before the
+                         ELB rotation starts, for recipes that support it. One of
+                         upload|extract|none; streamed artifacts are extracted with
+                         upload too. (default=upload)
+        refresh:         Re-discover the inventory instead of using the cache. (default=False)
     """
-    __read_config()
-
     if cfg and artifact_uri:
         raise Exception("The `cfg` and `artifact_uri` options are mutually exclusive!")
 
+    if stage not in ('upload', 'extract', 'none'):
+        raise Exception("The `stage` option must be one of upload|extract|none!")
+
     recipe = __load_recipe(app_name, cfg)
 
-    ## get list of ELBs to bleed instances out-of/into during deployment
-    elbs = aws.get_elbs(app_name, environment)
+    with timing.span('discovery', host='localhost'):
+        ## get list of ELBs to bleed instances out-of/into during deployment
+        elbs = aws.get_elbs(app_name, environment, refresh=__is_true(refresh))
+
+        ## get list of instances to bleed out-of/into the ELBs
+        instances = __get_instances_for_app(app_name, environment, __is_true(refresh))
     if not elbs:
         print 'WARNING: No ELBs found for app. Continuing with rude deployment...'
-
-    ## get list of instances to bleed out-of/into the ELBs
-    instances = __get_instances_for_app(app_name, environment)
+    __print_inventory_cache_stats()
     if not instances:
         print 'ERROR: no target instances found for deployment!'
         exit(1)
+    __prewarm_connections(instances)
 
-    ## iterate over instances, removing from ELBs, deploying, then re-registering into ELBs
-    for i in instances:
-        for elb_name in elbs:
-            aws.remove_instance_from_elb(elb_name, i.instance_id)
+    ## fetch the artifact once up front, so parallel waves share the local copy
+    if artifact_uri:
+        execute(tasks.local_fetch_s3_artifact, artifact_uri)
 
-        if cfg:
-            execute(recipe.deploy, cfg=cfg, hosts=[i.instance_ip])
-        else:
-            execute(recipe.deploy, uri=artifact_uri, hosts=[i.instance_ip])
+    ## push the artifact to every instance in parallel, before any of them are drained
+    deploy_kwargs = {'uri': artifact_uri}
+    if __stage_artifact(app_name, recipe, artifact_uri, instances, stage):
+        deploy_kwargs['staged'] = True
+
+    ## iterate over waves of instances, removing from ELBs, deploying, then re-registering
+    if cfg:
+        __rolling_execute(instances, elbs, max_unavailable, __get_health_check_url(recipe),
+                          recipe.deploy, cfg=cfg)
+    else:
+        __rolling_execute(instances, elbs, max_unavailable, __get_health_check_url(recipe),
+                          recipe.deploy, **deploy_kwargs)
+    __print_connection_stats()
+
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+@__timeline
+def deploy_many(manifest, environment, max_unavailable=None, stage='upload', refresh=False):
+    """Does rolling deployments of several apps in one run, discovering the inventory
+    once for all of them. Apps that share no instances are deployed at the same time,
+    unless they share an ELB; apps on the same instances are deployed together, so each
+    instance is only taken out of its ELBs once.
+
+    Args:
+        manifest:        A JSON object of app/recipe name -> S3 URL of the artifact to
+                         deploy (either a filename or raw json string).
+        environment:     The environment (i.e. dev|stg|prd) to deploy to.
+
+    KW-Args:
+        max_unavailable: The number (i.e. 5) or percentage (i.e. 25%) of each group of
+                         apps' instances to deploy to in parallel per wave. (default=1)
+        stage:           How to pre-stage the artifacts, see `deploy_rolling`.
+                         (default=upload)
+        refresh:         Re-discover the inventory instead of using the cache. (default=False)
+    """
+    if stage not in ('upload', 'extract', 'none'):
+        raise Exception("The `stage` option must be one of upload|extract|none!")
+
+    manifest = read_json_config(manifest)
+    if not manifest:
+        print 'ERROR: no apps to deploy in the manifest!'
+        exit(1)
+    recipes = {app_name: __load_recipe(app_name) for app_name in manifest}
+
+    with timing.span('discovery', host='localhost'):
+        ## one ELB tag scan and one EC2 lookup, shared by every app
+        elb_index = aws.get_elb_index(refresh=__is_true(refresh))
+        inventory = aws.get_instances(environment=environment, refresh=__is_true(refresh))
+    __print_inventory_cache_stats()
+
+    app_elbs = {}
+    for app_name in sorted(manifest):
+        app_elbs[app_name] = aws.get_elbs(app_name, environment, elb_index=elb_index)
+        if not app_elbs[app_name]:
+            print 'WARNING: No ELBs found for [{}]. Continuing with rude deployment...'.format(
+                app_name)
+        if not inventory.for_app(app_name):
+            print 'ERROR: no target instances found for [{}]!'.format(app_name)
+            exit(1)
+
+    groups = __group_co_hosted_apps(inventory, sorted(manifest))
+    __prewarm_connections([i for (_, instances) in groups for i in instances])
+
+    ## fetch and stage every artifact up front, before any instance is drained
+    app_deploys = {}
+    for app_name in sorted(manifest):
+        execute(tasks.local_fetch_s3_artifact, manifest[app_name])
+        deploy_kwargs = {'uri': manifest[app_name]}
+        if __stage_artifact(app_name, recipes[app_name], manifest[app_name],
+                            inventory.for_app(app_name), stage):
+            deploy_kwargs['staged'] = True
+        app_deploys[app_name] = (recipes[app_name], deploy_kwargs)
+
+    ## roll each group of co-hosted apps through its own waves, all groups at once, except
+    ## that groups behind the same ELB take turns, to keep it within `max_unavailable`
+    lanes = __group_by_shared_elbs(groups, app_elbs)
+    for lane in lanes:
+        print 'Deploying {} to [{}] instances...'.format(
+            ' then '.join(str(group_apps) for (group_apps, _) in lane),
+            sum(len(instances) for (_, instances) in lane))
+    __run_in_parallel([
+        ('+'.join(','.join(group_apps) for (group_apps, _) in lane), __rolling_execute_groups,
+         (lane, app_elbs, max_unavailable, app_deploys))
+        for lane in lanes])
+    __print_connection_stats()
+
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+@__timeline
+def rollback_rolling(app_name, environment, max_unavailable=None, refresh=False):
+    """Rolls the app back to its previous release on every instance, by switching
+    the `current` symlink back to it, without re-deploying an older artifact.
+
+    Args:
+        app_name:        The name of the app/recipe to roll back.
+        environment:     The environment (i.e. dev|stg|prd) to roll back.
+
+    KW-Args:
+        max_unavailable: The number (i.e. 5) or percentage (i.e. 25%) of instances
+                         to roll back in parallel per wave. (default=1)
+        refresh:         Re-discover the inventory instead of using the cache. (default=False)
+    """
+    recipe = __load_recipe(app_name)
+    if not hasattr(recipe, 'rollback'):
+        print 'ERROR: the recipe for [{}] does not support rollbacks!'.format(app_name)
+        exit(1)
+
+    with timing.span('discovery', host='localhost'):
+        ## get list of ELBs to bleed instances out-of/into during the rollback
+        elbs = aws.get_elbs(app_name, environment, refresh=__is_true(refresh))
+
+        ## get list of instances to bleed out-of/into the ELBs
+        instances = __get_instances_for_app(app_name, environment, __is_true(refresh))
+    if not elbs:
+        print 'WARNING: No ELBs found for app. Continuing with rude rollback...'
+
+    __print_inventory_cache_stats()
+    if not instances:
+        print 'ERROR: no target instances found for rollback!'
+        exit(1)
+    __prewarm_connections(instances)
+
+    ## make sure every instance has a release to go back to, before draining any of them
+    with settings(hide('running', 'stdout'), parallel=True, pool_size=tasks.get_pool_size()):
+        targets = execute(tasks.get_rollback_target, app_name,
+                          hosts=[i.instance_ip for i in instances])
+    missing = [i for i in instances if not targets.get(i.instance_ip)]
+    if missing:
+        print 'ERROR: no previous release to roll back to on {}'.format(
+            ['{} ({})'.format(i.instance_id, i.instance_ip) for i in missing])
+        exit(1)
+
+    ## iterate over waves of instances, removing from ELBs, rolling back, then re-registering
+    __rolling_execute(instances, elbs, max_unavailable, __get_health_check_url(recipe),
+                      recipe.rollback)
+    __print_connection_stats()
 
-        for elb_name in elbs:
-            aws.add_instance_to_elb(elb_name, i.instance_id)
+
+@task
+@runs_once
+@hosts('127.0.0.1')
+def clear_inventory_cache():
+    """Removes all cached EC2/ELB inventory for the current AWS account and region."""
+    __read_config()
+    aws.invalidate_inventory_cache()
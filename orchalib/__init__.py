@@ -2,8 +2,6 @@
 
 import json
 
-from requests import codes
-
 
 DEFAULT_OWNER = 'ci:www-data'
 
@@ -17,6 +15,8 @@ def is_response_valid(res):
     Returns:
         boolean
     """
+    from requests import codes
+
     return res.status_code >= codes.ok and res.status_code < codes.multiple_choices
 
 
@@ -75,3 +75,29 @@ def get_current_release_dir(app_name):
         a string representing path to current release
     """
     return '{}/releases/curr'.format(get_app_basedir(app_name))
+
+
+def get_staging_release_dir(app_name):
+    """Get the directory that a release is pre-extracted into, ahead of
+    being rotated into place as the current release.
+
+    Args:
+        app_name: a string representing the app name
+
+    Returns:
+        a string representing path to the staged release
+    """
+    return '{}/releases/next'.format(get_app_basedir(app_name))
+
+
+def get_release_store_dir(app_name):
+    """Get the directory of the host's release store for the specified app,
+    which holds a release per artifact checksum, when the store is enabled.
+
+    Args:
+        app_name: a string representing the app name
+
+    Returns:
+        a string representing path to the release store
+    """
+    return '{}/releases/store'.format(get_app_basedir(app_name))
@@ -0,0 +1,168 @@
+"""Local, content-addressed cache of deployment artifacts fetched from S3"""
+
+import hashlib
+import json
+import os
+import shutil
+from time import time
+
+from . import aws
+
+
+# opt-in cache of downloaded artifacts (see `enable_artifact_cache`)
+ARTIFACT_CACHE = {
+    'dir': None,
+    'max_bytes': 10 * 1024 * 1024 * 1024,
+}
+
+# seconds before a partial download (one with no metadata yet) is assumed
+# to have been abandoned, rather than still in progress in another process
+PARTIAL_ENTRY_TTL = 24 * 60 * 60
+
+# sha1 checksums of local artifacts, keyed by (path, size, mtime)
+__CHECKSUMS = {}
+
+
+def enable_artifact_cache(cache_dir, max_size_mb=10240):
+    """Turns on the local artifact cache.
+
+    Args:
+        cache_dir: The directory to store cached artifacts in.
+        max_size_mb: (optional) The size the cache is pruned down to, in MB.
+    """
+    ARTIFACT_CACHE['dir'] = os.path.expanduser(cache_dir)
+    ARTIFACT_CACHE['max_bytes'] = int(max_size_mb) * 1024 * 1024
+    if not os.path.isdir(ARTIFACT_CACHE['dir']):
+        os.makedirs(ARTIFACT_CACHE['dir'])
+
+
+def is_artifact_cache_enabled():
+    """Returns boolean indicating the artifact cache is enabled or not."""
+    return ARTIFACT_CACHE['dir'] is not None
+
+
+def __get_entry_dir(bucket, key, etag):
+    """Returns the cache directory for one version of an S3 object."""
+    digest = hashlib.sha1('{}/{}/{}'.format(bucket, key, etag)).hexdigest()
+    return os.path.join(ARTIFACT_CACHE['dir'], digest)
+
+
+def __link_or_copy(src, dest):
+    """Hardlinks `src` to `dest`, falling back to a copy across filesystems."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def fetch_artifact(uri, local_dest='.'):
+    """Places an S3 artifact at `local_dest`, from the cache if this version
+    of it (by ETag) was downloaded before, otherwise from S3.
+
+    Args:
+        uri: An S3 URI to the artifact.
+        local_dest: (optional) A directory or filename to place the artifact at.
+
+    Returns:
+        a string representing path to the local artifact
+    """
+    (bucket, key) = aws.parse_s3_uri(uri)
+    filename = local_dest
+    if os.path.isdir(local_dest):
+        filename = os.path.join(local_dest, os.path.basename(key))
+
+    head = aws.get_client("s3").head_object(Bucket=bucket, Key=key)
+    entry_dir = __get_entry_dir(bucket, key, head['ETag'])
+    cached = os.path.join(entry_dir, os.path.basename(key))
+    meta_file = os.path.join(entry_dir, 'meta.json')
+
+    if os.path.exists(meta_file):
+        print "Using cached artifact for [{}].".format(uri)
+    else:
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir)
+        aws.download_s3_artifact(uri, cached, head=head)
+        with open(meta_file, 'w') as meta:
+            json.dump({
+                'uri': uri,
+                'etag': head['ETag'].strip('"'),
+                'size': head['ContentLength'],
+                'fetched': time(),
+            }, meta)
+        prune_artifact_cache(keep_latest=True)
+
+    # bump the entry's mtime, which is what LRU eviction goes by
+    os.utime(entry_dir, None)
+
+    __link_or_copy(cached, filename)
+    return filename
+
+
+def get_artifact_checksum(filename):
+    """Returns the sha1 hex digest of a local artifact. Each version of a file
+    is only read once per process, and forked workers inherit the result.
+
+    Args:
+        filename: The path to the local artifact.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in __CHECKSUMS:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(aws.S3_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        __CHECKSUMS[key] = sha1.hexdigest()
+    return __CHECKSUMS[key]
+
+
+def list_cached_artifacts():
+    """Returns a list of dicts describing cached artifacts, most recently used first."""
+    entries = []
+    if not is_artifact_cache_enabled():
+        return entries
+
+    for name in os.listdir(ARTIFACT_CACHE['dir']):
+        entry_dir = os.path.join(ARTIFACT_CACHE['dir'], name)
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as meta:
+                entry = json.load(meta)
+        except (IOError, ValueError):
+            # partial download, left behind by an interrupted fetch
+            entry = {'uri': None, 'etag': None, 'size': 0, 'fetched': None}
+        entry['path'] = entry_dir
+        entry['last_used'] = os.path.getmtime(entry_dir)
+        entries.append(entry)
+
+    return sorted(entries, key=lambda e: e['last_used'], reverse=True)
+
+
+def prune_artifact_cache(max_bytes=None, keep_latest=False):
+    """Evicts least recently used artifacts until the cache fits in `max_bytes`.
+
+    Args:
+        max_bytes: (optional) The size to prune down to. (default=the configured size)
+        keep_latest: (optional) Never evict the most recently used artifact.
+
+    Returns:
+        a list of dicts describing the evicted artifacts
+    """
+    if max_bytes is None:
+        max_bytes = ARTIFACT_CACHE['max_bytes']
+
+    evicted = []
+    total = 0
+    for (index, entry) in enumerate(list_cached_artifacts()):
+        total += entry['size']
+        if entry['uri'] is None:
+            expired = time() - entry['last_used'] > PARTIAL_ENTRY_TTL
+        else:
+            expired = total > max_bytes and not (keep_latest and index == 0)
+
+        if expired:
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            evicted.append(entry)
+
+    return evicted
@@ -1,18 +1,121 @@
 """Helper functions for reading AWS EC2 instances and ELBs"""
 
-from time import sleep
+import hashlib
+import json
+import os
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import sleep, time
 from datetime import date, timedelta
-import boto3
-from orchalib.models.aws import Ec2Instance
-from botocore.exceptions import ClientError
+from multiprocessing.pool import ThreadPool
+from orchalib import timing
+from orchalib.models.aws import Ec2Instance, Ec2InstanceCollection, ElbRegistration
+
+# boto3 and botocore are imported on first use rather than here, since they
+# take longer to import than the rest of deploytool together, and many tasks
+# (i.e. `fab -l`) never call AWS
 
 
 DEBUG = False
 
+# maximum number of load balancer names per ELB `describe_tags` call
+ELB_TAGS_BATCH_SIZE = 20
+
+# polling schedule (in seconds) while waiting for ELB connection draining;
+# the grace period is allowed on top of the ELB's own draining timeout
+DRAIN_POLL_MIN_DELAY = 1.0
+DRAIN_POLL_MAX_DELAY = 5.0
+DRAIN_POLL_BACKOFF = 1.5
+DRAIN_GRACE_PERIOD = 5
+
+# polling schedule (in seconds) while waiting for instances to become
+# healthy in an ELB, and the max time to wait for them
+HEALTH_POLL_MIN_DELAY = 2.0
+HEALTH_POLL_MAX_DELAY = 10.0
+HEALTH_POLL_BACKOFF = 1.5
+HEALTH_MAX_WAIT = 300
+
+# ranged S3 downloads: bytes per ranged GET, max GETs in flight, and
+# bytes read from each response at a time
+S3_PART_SIZE = 16 * 1024 * 1024
+S3_CONCURRENCY = 10
+S3_CHUNK_SIZE = 1024 * 1024
+
+# settings for the process-wide boto3 clients (see `get_client`)
+CLIENT_POOL = {
+    'max_pool_connections': 10,
+}
+
+# opt-in on-disk cache of instance and ELB inventory (see `enable_inventory_cache`)
+INVENTORY_CACHE = {
+    'dir': None,
+    'ttl': 300,
+    'prefix': None,
+}
+INVENTORY_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+}
+
+# boto3 sessions and clients, keyed by process id so that forked Fabric
+# workers never share HTTP connections with their parent
+__SESSIONS = {}
+__CLIENTS = {}
+__CLIENTS_LOCK = Lock()
+
+# private IP of every instance discovered by this process (and its parent),
+# so that ELB spans are recorded under the same host as fabric's spans
+__INSTANCE_HOSTS = {}
+
+
+def set_max_pool_connections(max_pool_connections):
+    """Sets the HTTP connection pool size of each boto3 client. Only clients
+    created after this call are affected, so call it before any AWS helper.
+
+    Args:
+        max_pool_connections: The max number of connections per client.
+    """
+    CLIENT_POOL['max_pool_connections'] = int(max_pool_connections)
+
+
+def get_session():
+    """Returns the boto3 session shared by all AWS helpers in this process."""
+    import boto3
+
+    pid = os.getpid()
+    with __CLIENTS_LOCK:
+        if pid not in __SESSIONS:
+            __SESSIONS[pid] = boto3.session.Session()
+        return __SESSIONS[pid]
+
+
+def get_client(service, region=None):
+    """Returns a boto3 client shared by all AWS helpers in this process.
+
+    Clients are built once per service and region, since construction loads
+    the service model and resolves credentials, and so that HTTP connections
+    are reused between calls. boto3 clients are safe to share across threads.
+
+    Args:
+        service: The AWS service name, i.e. 'ec2'.
+        region: (optional) The AWS region. (default=the session's region)
+    """
+    from botocore.config import Config
+
+    session = get_session()
+    key = (os.getpid(), service, region)
+    with __CLIENTS_LOCK:
+        if key not in __CLIENTS:
+            config = Config(max_pool_connections=CLIENT_POOL['max_pool_connections'])
+            __CLIENTS[key] = timing.instrument_client(
+                session.client(service, region_name=region, config=config))
+        return __CLIENTS[key]
+
 
 def list_recent_artifacts(appname, numweeks):
     """Returns a list of artifacts based on YYYY.WW S3 prefix."""
-    s3 = boto3.client("s3")
+    s3 = get_client("s3")
     this_week = date.today()
     this_week_str = this_week.strftime("%Y.%W")
     objects = {}
@@ -35,11 +138,274 @@ def list_recent_artifacts(appname, numweeks):
     return artifact_urls
 
 
-def get_instances(environment=None):
-    """Returns a list of Ec2Instance objects."""
+def parse_s3_uri(uri):
+    """Returns a (bucket, key) tuple for an `s3://bucket/key` URI."""
+    if not uri.startswith('s3://') or '/' not in uri[5:]:
+        raise Exception('[{}] is not an S3 URI!'.format(uri))
+    return tuple(uri[5:].split('/', 1))
+
+
+def __get_s3_ranges(size, part_size):
+    """Returns a list of (start, end) inclusive byte ranges covering `size` bytes."""
+    return [(start, min(start + part_size, size) - 1) for start in xrange(0, size, part_size)]
+
+
+def __download_s3_range(bucket, key, etag, byte_range, filename):
+    """Fetches one byte range of an S3 object into the same offset of `filename`."""
+    s3 = get_client("s3")
+    resp = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                         Range='bytes={}-{}'.format(*byte_range))
+    with open(filename, 'r+b') as dest:
+        dest.seek(byte_range[0])
+        for chunk in iter(lambda: resp['Body'].read(S3_CHUNK_SIZE), b''):
+            dest.write(chunk)
+
+
+def __is_etag_md5(head):
+    """Returns boolean indicating an object's ETag, from its `head_object`
+    response, is made of MD5s of its content or not. It isn't for objects
+    encrypted with SSE-KMS or SSE-C."""
+    return not (head.get('ServerSideEncryption', '').startswith('aws:kms') or
+                'SSECustomerAlgorithm' in head)
+
+
+def __get_s3_etag(filename, size, num_parts):
+    """Returns the ETag S3 would compute for `filename`, uploaded in `num_parts`
+    parts, or None if the upload's part size can't be worked out."""
+    if num_parts == 0:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(S3_CHUNK_SIZE), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    # multipart ETags are the md5 of the parts' md5s; try the part size used by
+    # the AWS CLI, then the smallest whole number of MBs that yields num_parts
+    mbyte = 1024 * 1024
+    for part_size in (8 * mbyte, -(-size // num_parts // mbyte) * mbyte or mbyte):
+        if -(-size // part_size) != num_parts:
+            continue
+        digests = []
+        with open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(part_size), b''):
+                digests.append(hashlib.md5(chunk).digest())
+        return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), num_parts)
+
+    return None
+
+
+def download_s3_artifact(uri, local_dest='.', part_size=S3_PART_SIZE,
+                         concurrency=S3_CONCURRENCY, head=None):
+    """Downloads an S3 object with concurrent ranged GETs, and verifies its
+    size and ETag once complete.
+
+    Every range is requested with the ETag seen up front, so the object can't
+    change part way through. The download is written to a temp file and only
+    renamed into place once verified.
+
+    Args:
+        uri: An S3 URI to the artifact.
+        local_dest: (optional) A directory or filename to download to.
+        part_size: (optional) Bytes fetched per ranged GET.
+        concurrency: (optional) Max number of ranged GETs in flight.
+        head: (optional) A `head_object` response already fetched for the URI.
+
+    Returns:
+        a string representing path to the downloaded file
+    """
+    (bucket, key) = parse_s3_uri(uri)
+    filename = local_dest
+    if os.path.isdir(local_dest):
+        filename = os.path.join(local_dest, os.path.basename(key))
+
+    if head is None:
+        head = get_client("s3").head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    etag = head['ETag']
+    ranges = __get_s3_ranges(size, int(part_size))
+
+    print "Downloading [{}] ({} bytes) to [{}]...".format(uri, size, filename)
+    start = time()
+
+    tmp = NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(filename)),
+                             prefix='.{}.'.format(os.path.basename(filename)), delete=False)
+    try:
+        with tmp:
+            tmp.truncate(size)
+
+        if ranges:
+            pool = ThreadPool(max(1, min(int(concurrency), len(ranges))))
+            try:
+                pool.map(lambda byte_range: __download_s3_range(bucket, key, etag,
+                                                                byte_range, tmp.name),
+                         ranges)
+            finally:
+                pool.close()
+
+        elapsed = time() - start
+
+        # verify what landed on disk against what S3 told us up front
+        if os.path.getsize(tmp.name) != size:
+            raise Exception('Downloaded size of [{}] does not match S3!'.format(uri))
+
+        expected = etag.strip('"')
+        num_parts = int(expected.split('-')[1]) if '-' in expected else 0
+        if not __is_etag_md5(head):
+            print "WARNING: could not verify the ETag of encrypted [{}].".format(uri)
+        else:
+            actual = __get_s3_etag(tmp.name, size, num_parts)
+            if actual is None:
+                print "WARNING: could not verify the multipart ETag of [{}].".format(uri)
+            elif actual != expected:
+                raise Exception('Downloaded ETag of [{}] does not match S3!'.format(uri))
+
+        os.rename(tmp.name, filename)
+    finally:
+        # only left behind if the download failed
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+
+    print "Downloaded [{}] in [{:.1f}] seconds ({:.1f} MB/s).".format(
+        filename, elapsed, size / max(elapsed, 0.001) / (1024 * 1024))
+
+    return filename
+
+
+def enable_inventory_cache(cache_dir, ttl=300):
+    """Turns on the on-disk inventory cache shared across fab tasks.
+
+    Args:
+        cache_dir: The directory to store cached inventory in.
+        ttl: (optional) Seconds before a cached inventory is re-discovered.
+    """
+    INVENTORY_CACHE['dir'] = os.path.expanduser(cache_dir)
+    INVENTORY_CACHE['ttl'] = int(ttl)
+    INVENTORY_CACHE['prefix'] = None
+    if not os.path.isdir(INVENTORY_CACHE['dir']):
+        os.makedirs(INVENTORY_CACHE['dir'])
+
+
+def is_inventory_cache_enabled():
+    """Returns boolean indicating the inventory cache is enabled or not."""
+    return INVENTORY_CACHE['dir'] is not None
+
+
+def get_inventory_cache_stats():
+    """Returns a dict of the inventory cache hit/miss/refresh counts."""
+    return dict(INVENTORY_CACHE_STATS)
+
+
+def get_account_and_region():
+    """Returns an (account id, region name) tuple for the current credentials."""
+    account = get_client('sts').get_caller_identity()['Account']
+    region = get_session().region_name or 'default'
+    return (account, region)
+
+
+def __get_inventory_cache_prefix():
+    """Returns the prefix of the current account and region's cache files. It's
+    only looked up on first use, so that tasks that never touch the inventory
+    don't pay for an STS call."""
+    if INVENTORY_CACHE['prefix'] is None:
+        INVENTORY_CACHE['prefix'] = '-'.join(get_account_and_region())
+    return INVENTORY_CACHE['prefix']
+
+
+def __get_inventory_cache_file(kind, environment=None):
+    """Returns the cache file path for the given kind of inventory."""
+    key = [__get_inventory_cache_prefix(), kind]
+    if environment is not None:
+        key.append(environment)
+    return os.path.join(INVENTORY_CACHE['dir'], '{}.json'.format('-'.join(key)))
+
+
+def __read_inventory_cache(kind, environment=None, refresh=False):
+    """Returns the cached inventory, or None if it's missing, expired, or
+    a refresh was requested."""
+    if refresh:
+        INVENTORY_CACHE_STATS['refreshes'] += 1
+        return None
+
+    cache_file = __get_inventory_cache_file(kind, environment)
+    try:
+        with open(cache_file, 'r') as cache:
+            cached = json.load(cache)
+    except (IOError, ValueError):
+        INVENTORY_CACHE_STATS['misses'] += 1
+        return None
+
+    if time() - cached['created'] > INVENTORY_CACHE['ttl']:
+        INVENTORY_CACHE_STATS['misses'] += 1
+        return None
+
+    INVENTORY_CACHE_STATS['hits'] += 1
+    return cached['data']
+
+
+def __write_inventory_cache(kind, data, environment=None):
+    """Atomically stores inventory in the cache."""
+    cache_file = __get_inventory_cache_file(kind, environment)
+    tmp = NamedTemporaryFile('w', dir=INVENTORY_CACHE['dir'], delete=False)
+    with tmp:
+        json.dump({'created': time(), 'data': data}, tmp)
+    os.rename(tmp.name, cache_file)
+
+
+def invalidate_inventory_cache():
+    """Removes all cached inventory for the current account and region."""
+    if not is_inventory_cache_enabled():
+        return
+
+    prefix = __get_inventory_cache_prefix() + '-'
+    for name in os.listdir(INVENTORY_CACHE['dir']):
+        if name.startswith(prefix) and name.endswith('.json'):
+            os.remove(os.path.join(INVENTORY_CACHE['dir'], name))
+
+
+def get_instance_host(instance_id):
+    """Returns the host (private IP) fabric connects to for an instance, as
+    discovered by `get_instances`, or the instance id if it wasn't."""
+    return __INSTANCE_HOSTS.get(instance_id) or instance_id
+
+
+def get_app_tag_filter(app):
+    """Returns an EC2 filter matching instances whose comma-separated `Apps`
+    tag may contain `app`. Matches still need confirming with `has_app`."""
+    return {
+        'Name': 'tag:Apps',
+        'Values': [app, '{},*'.format(app), '*,{}'.format(app), '*,{},*'.format(app)]
+    }
+
+
+def __describe_instances(filters):
+    """Returns a list of raw instance dicts (id, private IP and tags) matching `filters`."""
     instances = []
-    ec2 = boto3.client("ec2")
+    ec2 = get_client("ec2")
+
+    for ec2_data in ec2.get_paginator('describe_instances').paginate(Filters=filters):
+        for res in ec2_data['Reservations']:
+            for i in res['Instances']:
+                instances.append({
+                    'InstanceId': i['InstanceId'],
+                    'PrivateIpAddress': i.get('PrivateIpAddress'),
+                    'Tags': i.get('Tags', []),
+                })
+
+    return instances
+
 
+def get_instances(environment=None, app=None, refresh=False):
+    """Returns an Ec2InstanceCollection of Ec2Instance objects.
+
+    When the inventory cache is enabled, the whole environment's inventory
+    is cached, so that lookups for other apps can be served from it too.
+
+    Args:
+        environment: (optional) Only return running instances in this environment.
+        app: (optional) Only return instances tagged with this app.
+        refresh: (optional) Bypass and re-populate the inventory cache.
+    """
+    filters = []
     if environment is not None:
         ec2_env_filter = {
             'Name': 'tag:Environment',
@@ -49,35 +415,129 @@ def get_instances(environment=None):
             'Name': 'instance-state-name',
             'Values': ['running']
         }
-        ec2_data = ec2.describe_instances(Filters=[ec2_env_filter, ec2_state_filter])
+        filters.extend([ec2_env_filter, ec2_state_filter])
+
+    if environment is not None and is_inventory_cache_enabled():
+        ec2_data = __read_inventory_cache('instances', environment, refresh)
+        if ec2_data is None:
+            ec2_data = __describe_instances(filters)
+            __write_inventory_cache('instances', ec2_data, environment)
     else:
-        ec2_data = ec2.describe_instances()
+        if app is not None:
+            filters.append(get_app_tag_filter(app))
+        ec2_data = __describe_instances(filters)
 
-    for res in ec2_data['Reservations']:
-        for i in res['Instances']:
-            instances.append(Ec2Instance(i['InstanceId'], i['PrivateIpAddress'], i['Tags']))
+    instances = []
+    for i in ec2_data:
+        instance = Ec2Instance(i['InstanceId'], i['PrivateIpAddress'], i['Tags'])
+        __INSTANCE_HOSTS[instance.instance_id] = instance.instance_ip
+        if app is None or instance.has_app(app):
+            instances.append(instance)
+
+    return Ec2InstanceCollection(instances)
+
+
+def get_elb_index(refresh=False):
+    """Returns a dict of (environment, app) -> list of elb names.
+
+    Discovery is a single paginated pass over all classic ELBs, with their
+    tags fetched in batches, so one index can answer lookups for many apps.
+    The index covers every environment, and is cached as a whole when the
+    inventory cache is enabled.
+
+    Args:
+        refresh: (optional) Bypass and re-populate the inventory cache.
+    """
+    if is_inventory_cache_enabled():
+        cached = __read_inventory_cache('elbs', refresh=refresh)
+        if cached is not None:
+            return {(env, app): names for (env, app, names) in cached}
+
+    index = {}
+    elb_data = get_client('elb')
+
+    elb_names = []
+    for page in elb_data.get_paginator('describe_load_balancers').paginate():
+        for elb in page['LoadBalancerDescriptions']:
+            elb_names.append(elb['LoadBalancerName'])
+
+    for start in xrange(0, len(elb_names), ELB_TAGS_BATCH_SIZE):
+        tags = elb_data.describe_tags(
+            LoadBalancerNames=elb_names[start:start + ELB_TAGS_BATCH_SIZE])
+        for desc in tags['TagDescriptions']:
+            elb_tags = {tag['Key']: tag['Value'] for tag in desc['Tags']}
+            if 'Environment' not in elb_tags or 'Apps' not in elb_tags:
+                continue
+            for app in elb_tags['Apps'].split(','):
+                key = (elb_tags['Environment'], app)
+                index.setdefault(key, []).append(desc['LoadBalancerName'])
 
-    return instances
+    if DEBUG:
+        print index
 
+    if is_inventory_cache_enabled():
+        __write_inventory_cache('elbs', [[env, app, names]
+                                         for ((env, app), names) in index.items()])
 
-def get_elbs(app, env):
-    """Returns a list of strings of elb names."""
-    elbs = []
-    elb_data = boto3.client('elb')
+    return index
 
-    for elb in elb_data.describe_load_balancers()['LoadBalancerDescriptions']:
-        tags = elb_data.describe_tags(LoadBalancerNames=[elb['LoadBalancerName']])
-        elb_tags = {tag['Key']: tag['Value'] for tag in tags['TagDescriptions'][0]['Tags']}
-        if 'Environment' in elb_tags and elb_tags['Environment'] == env and \
-           'Apps' in elb_tags and app in elb_tags['Apps'].split(','):
-            elbs.append(elb['LoadBalancerName'])
 
-    return elbs
+def get_elbs(app, env, elb_index=None, refresh=False):
+    """Returns a list of strings of elb names.
+
+    Args:
+        app: The name of the app.
+        env: The environment for the specified app.
+        elb_index: (optional) An index from `get_elb_index`, to reuse
+                   across lookups instead of re-discovering ELBs.
+        refresh: (optional) Bypass and re-populate the inventory cache.
+    """
+    if elb_index is None:
+        elb_index = get_elb_index(refresh)
+    return list(elb_index.get((env, app), []))
+
+
+def __get_registered_states(elb, load_balancer_name, instance_ids):
+    """Returns a dict of instance id -> state in the ELB for each of `instance_ids`,
+    with one batched call. Instances are asked for by id, since a listing of the
+    whole ELB leaves out instances whose deregistration is still in progress.
+    Instances the ELB doesn't know are left out."""
+    from botocore.exceptions import ClientError
+
+    try:
+        resp = elb.describe_instance_health(
+            LoadBalancerName=load_balancer_name,
+            Instances=[{'InstanceId': instance_id} for instance_id in instance_ids]
+        )
+    except ClientError as cle:
+        if cle.response['Error'].get('Code', 'Unknown') != 'InvalidInstance':
+            raise
+        # a single unknown instance fails the whole call, so find out which one it is
+        states = {}
+        if len(instance_ids) > 1:
+            for instance_id in instance_ids:
+                states.update(__get_registered_states(elb, load_balancer_name, [instance_id]))
+        return states
+
+    if DEBUG:
+        print resp
+
+    return {state['InstanceId']: state['State'] for state in resp['InstanceStates']}
 
 
 def remove_instance_from_elb(load_balancer_name, instance_id):
     """Removes an instance from an ELB, and blocks until success or error."""
-    elb = boto3.client("elb")
+    remove_instances_from_elb(load_balancer_name, [instance_id])
+
+
+def remove_instances_from_elb(load_balancer_name, instance_ids):
+    """Removes a wave of instances from an ELB, and blocks until success or error.
+
+    Health is polled on a backoff schedule, returning as soon as every instance
+    is out of service. The ELB's connection draining timeout is only the upper
+    bound on the wait.
+    """
+    elb = get_client("elb")
 
     # get ELB setting for connection draining timeout
     resp = elb.describe_load_balancer_attributes(LoadBalancerName=load_balancer_name)
@@ -85,122 +545,207 @@ def remove_instance_from_elb(load_balancer_name, instance_id):
     if resp['LoadBalancerAttributes']['ConnectionDraining']['Enabled']:
         timeout = resp['LoadBalancerAttributes']['ConnectionDraining']['Timeout']
 
-    # for each instance, remove from ELB
-    print "Removing instance [%s] from ELB [%s]..." % (instance_id, load_balancer_name)
+    # remove the whole wave from the ELB in a single call
+    print "Removing instances %s from ELB [%s]..." % (instance_ids, load_balancer_name)
+    start = time()
     resp = elb.deregister_instances_from_load_balancer(
         LoadBalancerName=load_balancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
+        Instances=[{'InstanceId': instance_id} for instance_id in instance_ids]
     )
 
     if DEBUG:
         print resp
 
-    try:
-        resp = elb.describe_instance_health(
-            LoadBalancerName=load_balancer_name,
-            Instances=[
-                {
-                    'InstanceId': instance_id
-                },
-            ]
-        )
-    except ClientError, cle:
-        error_code = cle.response['Error'].get('Code', 'Unknown')
-        if error_code == 'InvalidInstance':
-            print "De-registeration from ELB [{}] not required.".format(load_balancer_name)
-            return
-        else:
-            raise cle
+    # without connection draining, deregistration takes effect immediately
+    if timeout <= 0:
+        for instance_id in instance_ids:
+            timing.record('drain', start, time(), host=get_instance_host(instance_id),
+                          instance_id=instance_id, elb=load_balancer_name)
+        return
 
-    if DEBUG:
-        print resp
+    # wait for connection draining to complete, if necessary
+    deadline = start + timeout + DRAIN_GRACE_PERIOD
+    delay = DRAIN_POLL_MIN_DELAY
+    drained_at = {}
+    states = __get_registered_states(elb, load_balancer_name, instance_ids)
+    for instance_id in instance_ids:
+        if instance_id not in states:
+            print "De-registration of [{}] from ELB [{}] not required.".format(
+                instance_id, load_balancer_name)
+    draining = [i for i in instance_ids if states.get(i, 'OutOfService') != 'OutOfService']
+    if draining:
+        print "Waiting up to [%d] seconds for connection draining to complete..." % timeout
+
+    while draining and time() < deadline:
+        for instance_id in set(instance_ids) - set(draining) - set(drained_at):
+            drained_at[instance_id] = time()
+        sleep(min(delay, max(deadline - time(), 0)))
+        delay = min(delay * DRAIN_POLL_BACKOFF, DRAIN_POLL_MAX_DELAY)
+        states = __get_registered_states(elb, load_balancer_name, draining)
+        draining = [i for i in draining if states.get(i, 'OutOfService') != 'OutOfService']
+
+    for instance_id in instance_ids:
+        timing.record('drain', start, drained_at.get(instance_id, time()),
+                      host=get_instance_host(instance_id), instance_id=instance_id,
+                      elb=load_balancer_name, failed=instance_id in draining)
+        if instance_id in draining:
+            print "WARNING: Instance %s State is %s! Continuing." % (
+                instance_id, states.get(instance_id, 'Unknown'))
+        else:
+            print "Instance [{}] has been deregistered from ELB [{}].".format(instance_id,
+                                                                              load_balancer_name)
 
-    elb_instance_state = resp['InstanceStates'][0]['State']
 
-    # wait for connection draining to complete, if necessary
-    if timeout > 0 and elb_instance_state != 'OutOfService':
-        print "Waiting [%d] seconds for connection draining to complete..." % timeout
+def remove_instances_from_elbs(load_balancer_names, instance_ids):
+    """Removes a wave of instances from all of the given ELBs at once, and
+    blocks until success or error."""
+    remove_instances_from_elb_map({name: instance_ids for name in load_balancer_names})
 
-        while timeout > 0:
-            print '. ',
-            sleep(1)
-            timeout -= 1
-        print ''
 
-        sleep(5)
-        resp = elb.describe_instance_health(
-            LoadBalancerName=load_balancer_name,
-            Instances=[
-                {
-                    'InstanceId': instance_id
-                },
-            ]
-        )
+def remove_instances_from_elb_map(elb_instances):
+    """Removes a wave of instances from ELBs at once, and blocks until success
+    or error. Each ELB only has the instances listed for it removed.
 
-        if DEBUG:
-            print resp
+    Args:
+        elb_instances: A dict of ELB name -> ids of the EC2 instances to remove.
+    """
+    if not elb_instances:
+        return
 
-        if resp['InstanceStates'][0]['State'] != 'OutOfService':
-            print "WARNING: Instance %s State is %s! Continuing." % (
-                resp['InstanceStates'][0]['InstanceId'],
-                resp['InstanceStates'][0]['State']
-            )
-        else:
-            print "Instance [{}] has been deregistered from ELB [{}].".format(instance_id,
-                                                                              load_balancer_name)
+    pool = ThreadPool(len(elb_instances))
+    try:
+        pool.map(lambda name: remove_instances_from_elb(name, elb_instances[name]),
+                 sorted(elb_instances))
+    finally:
+        pool.close()
 
 
 def add_instance_to_elb(load_balancer_name, instance_id):
     """Registers an instance in an ELB, and blocks until healthy or error."""
-    elb = boto3.client("elb")
+    add_instances_to_elb(load_balancer_name, [instance_id])
 
-    print "Registering instance [%s] in ELB [%s]..." % (instance_id, load_balancer_name)
-    resp = elb.register_instances_with_load_balancer(
-        LoadBalancerName=load_balancer_name,
-        Instances=[
-            {
-                'InstanceId': instance_id
-            },
-        ]
-    )
-    if DEBUG:
-        print resp
 
-    # wait until instance is healthy
-    healthy = False
+def add_instances_to_elb(load_balancer_name, instance_ids):
+    """Registers a wave of instances in an ELB, and blocks until all are
+    healthy or error."""
+    for registration in add_instances_to_elbs([load_balancer_name], instance_ids):
+        if not registration.healthy:
+            raise Exception("Instance Not Healthy")
 
-    # max time to wait for instance to become healthy
-    max_wait = 300
 
-    # pause time between checks
-    check_delay = 5.0
-    loop_count = max_wait/check_delay
+def __register_instances(load_balancer_name, instance_ids, registrations):
+    """Registers instances in an ELB, recording any failure in `registrations`."""
+    from botocore.exceptions import ClientError
 
-    while not healthy:
-        print '. ',
-        sleep(check_delay)
-        resp = elb.describe_instance_health(
+    elb = get_client("elb")
+
+    print "Registering instances %s in ELB [%s]..." % (instance_ids, load_balancer_name)
+    try:
+        resp = elb.register_instances_with_load_balancer(
             LoadBalancerName=load_balancer_name,
-            Instances=[
-                {
-                    'InstanceId': instance_id
-                },
-            ]
+            Instances=[{'InstanceId': instance_id} for instance_id in instance_ids]
         )
+    except ClientError as cle:
+        for instance_id in instance_ids:
+            registrations[(instance_id, load_balancer_name)].error = \
+                cle.response['Error'].get('Code', 'Unknown')
+        return
+
+    if DEBUG:
+        print resp
 
-        if DEBUG:
-            print resp
 
-        if resp['InstanceStates'][0]['State'] == 'InService':
-            healthy = True
-            print "\nInstance [%s] is now [%s]" % (instance_id, resp['InstanceStates'][0]['State'])
+def add_instances_to_elbs(load_balancer_names, instance_ids, max_wait=HEALTH_MAX_WAIT):
+    """Registers a wave of instances in all of the given ELBs at once, and
+    blocks until all are healthy or `max_wait` seconds have passed.
+
+    Health is polled with one batched call per ELB on a backoff schedule.
+    Failures don't stop the wait for the other instances; they're reported
+    together at the end instead.
+
+    Args:
+        load_balancer_names: The names of the ELBs to register in.
+        instance_ids: The ids of the EC2 instances to register.
+        max_wait: (optional) Max seconds to wait for instances to become healthy.
+
+    Returns:
+        a list of ElbRegistration, one per instance and ELB
+    """
+    return add_instances_to_elb_map({name: instance_ids for name in load_balancer_names},
+                                    max_wait)
+
+
+def add_instances_to_elb_map(elb_instances, max_wait=HEALTH_MAX_WAIT):
+    """Registers a wave of instances in ELBs at once, like `add_instances_to_elbs`,
+    but each ELB only has the instances listed for it registered.
+
+    Args:
+        elb_instances: A dict of ELB name -> ids of the EC2 instances to register.
+        max_wait: (optional) Max seconds to wait for instances to become healthy.
+
+    Returns:
+        a list of ElbRegistration, one per instance and ELB
+    """
+    start = time()
+    registrations = {}
+    for (load_balancer_name, instance_ids) in elb_instances.items():
+        for instance_id in instance_ids:
+            registrations[(instance_id, load_balancer_name)] = \
+                ElbRegistration(instance_id, load_balancer_name)
+    if not registrations:
+        return []
+
+    elb = get_client("elb")
+    pool = ThreadPool(len(elb_instances))
+    try:
+        pool.map(lambda name: __register_instances(name, elb_instances[name], registrations),
+                 sorted(elb_instances))
+
+        # wait until every instance is healthy in every ELB
+        deadline = start + max_wait
+        delay = HEALTH_POLL_MIN_DELAY
+        pending = [r for r in registrations.values() if r.error is None]
+        while pending and time() < deadline:
+            sleep(min(delay, max(deadline - time(), 0)))
+            delay = min(delay * HEALTH_POLL_BACKOFF, HEALTH_POLL_MAX_DELAY)
+
+            pending_ids = {}
+            for registration in pending:
+                pending_ids.setdefault(registration.load_balancer_name, []).append(
+                    registration.instance_id)
+            pending_elbs = sorted(pending_ids)
+            states = dict(zip(pending_elbs, pool.map(
+                lambda name: __get_registered_states(elb, name, sorted(pending_ids[name])),
+                pending_elbs)))
+
+            for registration in pending:
+                registration.state = states[registration.load_balancer_name].get(
+                    registration.instance_id, 'Unknown')
+                if registration.state == 'InService':
+                    registration.seconds = time() - start
+                    print "Instance [%s] is now [%s] in ELB [%s]" % (
+                        registration.instance_id, registration.state,
+                        registration.load_balancer_name)
+            pending = [r for r in pending if r.state != 'InService']
+    finally:
+        pool.close()
+
+    for registration in pending:
+        registration.error = 'still [{}] after [{}] seconds'.format(registration.state, max_wait)
+
+    results = sorted(registrations.values(),
+                     key=lambda r: (r.instance_id, r.load_balancer_name))
+    for registration in results:
+        end = time() if registration.seconds is None else start + registration.seconds
+        timing.record('health_wait', start, end,
+                      host=get_instance_host(registration.instance_id),
+                      instance_id=registration.instance_id,
+                      elb=registration.load_balancer_name, failed=not registration.healthy)
+        if registration.healthy:
+            print "Instance [{}] healthy in ELB [{}] after [{:.1f}] seconds.".format(
+                registration.instance_id, registration.load_balancer_name, registration.seconds)
         else:
-            loop_count -= 1
-            if loop_count <= 0:
-                print "ERROR: Instance [{}] still unhealthy after [{}] seconds!".format(instance_id,
-                                                                                        max_wait)
-                raise Exception("Instance Not Healthy")
+            print "ERROR: Instance [{}] failed in ELB [{}]: {}".format(
+                registration.instance_id, registration.load_balancer_name, registration.error)
+
+    return results
@@ -0,0 +1,169 @@
+"""Helpers for sharing SSH connections to hosts across tasks and waves"""
+
+import hashlib
+import os
+import pipes
+import shlex
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from fabric.api import env
+import paramiko
+
+
+# opt-in multiplexing of SSH ProxyCommand (i.e. bastion) connections through
+# long-lived OpenSSH ControlMaster processes (see `enable_multiplexing`)
+MULTIPLEXING = {
+    'dir': None,
+    'persist': '15m',
+}
+
+# max number of connections opened at once when pre-warming
+PREWARM_CONCURRENCY = 20
+
+
+class MultiplexedSSHConfig(object):
+    """Wraps a paramiko SSHConfig, rewriting each host's ProxyCommand to go
+    through a shared ControlMaster. Fabric looks hosts up via `lookup`
+
+    """
+
+    def __init__(self, config):
+        self.config = config
+
+    def lookup(self, hostname):
+        """Returns the SSH config options for `hostname`."""
+        options = self.config.lookup(hostname)
+        if 'proxycommand' in options:
+            options = dict(options)
+            options['proxycommand'] = get_multiplexed_proxy_command(options['proxycommand'])
+        return options
+
+
+def enable_multiplexing(control_dir, persist='15m'):
+    """Routes the ProxyCommand of every host in the SSH config through an
+    OpenSSH ControlMaster, so that only the first connection through each
+    bastion pays for its handshake. Masters outlive fabric's forked parallel
+    workers, and stay up for `persist` after their last use, so that they
+    are shared by every wave and by back-to-back runs.
+
+    Args:
+        control_dir: The directory to keep ControlMaster sockets in.
+        persist: (optional) The OpenSSH ControlPersist time.
+    """
+    if not env.use_ssh_config:
+        print 'WARNING: SSH multiplexing needs `use_ssh_config`. Continuing without...'
+        return
+
+    MULTIPLEXING['dir'] = os.path.expanduser(control_dir)
+    MULTIPLEXING['persist'] = persist
+    if not os.path.isdir(MULTIPLEXING['dir']):
+        os.makedirs(MULTIPLEXING['dir'], 0o700)
+
+    config = paramiko.SSHConfig()
+    with open(os.path.expanduser(env.ssh_config_path)) as config_file:
+        config.parse(config_file)
+    # fabric keeps its parsed SSH config here, and reads it on every connect
+    env._ssh_config = MultiplexedSSHConfig(config)
+
+    # start a fresh log of connections for `get_pool_stats`
+    open(__get_log_file(), 'w').close()
+
+
+def is_multiplexing_enabled():
+    """Returns boolean indicating SSH multiplexing is enabled or not."""
+    return MULTIPLEXING['dir'] is not None
+
+
+def __get_log_file():
+    """Returns the path of the log of proxied connections for this run."""
+    return os.path.join(MULTIPLEXING['dir'], 'connections.log')
+
+
+def __get_control_path(proxy_args):
+    """Returns the ControlMaster socket for a ProxyCommand. Proxy commands
+    differing only in the `-W host:port` target share a master."""
+    key = []
+    args = iter(proxy_args)
+    for arg in args:
+        if arg == '-W':
+            next(args, None)
+        elif not arg.startswith('-W'):
+            key.append(arg)
+    # unix socket paths are short, so hash rather than use OpenSSH's %-tokens
+    return os.path.join(MULTIPLEXING['dir'], hashlib.sha1(' '.join(key)).hexdigest()[:12])
+
+
+def get_multiplexed_proxy_command(proxy_command):
+    """Returns `proxy_command` rewritten to go through a ControlMaster, and to
+    log whether it opened a new master or reused one. Proxy commands that
+    aren't `ssh` invocations are returned as-is.
+
+    Args:
+        proxy_command: the host's ProxyCommand, after token expansion.
+    """
+    args = shlex.split(proxy_command)
+    if not args or os.path.basename(args[0]) != 'ssh':
+        return proxy_command
+
+    control_path = __get_control_path(args[1:])
+    proxy = [args[0],
+             '-o', 'ControlMaster=auto',
+             '-o', 'ControlPath={}'.format(control_path),
+             '-o', 'ControlPersist={}'.format(MULTIPLEXING['persist'])] + args[1:]
+    script = ('if {ssh} -o ControlPath={path} -O check mux >/dev/null 2>&1; '
+              'then echo reused; else echo handshake; fi >> {log}; exec {proxy}').format(
+                  ssh=pipes.quote(args[0]),
+                  path=pipes.quote(control_path),
+                  log=pipes.quote(__get_log_file()),
+                  proxy=' '.join(pipes.quote(arg) for arg in proxy))
+    return 'sh -c {}'.format(pipes.quote(script))
+
+
+def __open_master(proxy_command):
+    """Runs a ProxyCommand with no input, which leaves its master running."""
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.call(proxy_command, shell=True, stdin=devnull, stdout=devnull,
+                        stderr=devnull)
+
+
+def prewarm(hosts):
+    """Opens the ControlMasters needed to reach `hosts` ahead of time, in
+    parallel, so that no deployment wave waits on a bastion handshake.
+
+    Args:
+        hosts: A list of host strings.
+    """
+    if not is_multiplexing_enabled():
+        return
+
+    masters = {}
+    for host in hosts:
+        proxy_command = env._ssh_config.config.lookup(host).get('proxycommand')
+        if proxy_command and os.path.basename(shlex.split(proxy_command)[0]) == 'ssh':
+            masters.setdefault(__get_control_path(shlex.split(proxy_command)[1:]),
+                               get_multiplexed_proxy_command(proxy_command))
+    if not masters:
+        return
+
+    pool = ThreadPool(min(len(masters), PREWARM_CONCURRENCY))
+    try:
+        pool.map(__open_master, masters.values())
+    finally:
+        pool.close()
+
+
+def get_pool_stats():
+    """Returns a dict of the number of proxied connections that needed a new
+    bastion `handshake`, and the number that `reused` an open master."""
+    stats = {'handshakes': 0, 'reused': 0}
+    if not is_multiplexing_enabled():
+        return stats
+
+    with open(__get_log_file(), 'r') as log:
+        for line in log:
+            if line.strip() == 'handshake':
+                stats['handshakes'] += 1
+            elif line.strip() == 'reused':
+                stats['reused'] += 1
+    return stats
@@ -0,0 +1,164 @@
+"""Helpers for shipping only the files of an artifact that a host doesn't already have"""
+
+import hashlib
+import os
+import tarfile
+
+
+# names of the files listing paths to hardlink from the host's existing
+# releases, alongside the delta artifact in the remote temp dir
+DELTA_LINK_LISTS = {
+    'curr': '.delta-links-curr',
+    'prev': '.delta-links-prev',
+}
+
+# name of the file in each release built by a delta transfer that holds the
+# manifest of the artifact it was built from, so that the next delta can be
+# planned without reading the release's files on the host
+DELTA_MANIFEST = '.deploytool-manifest'
+
+# tarfile modes for the artifact formats delta transfers can read
+DELTA_READ_MODES = [
+    (('.tar.gz', '.tgz'), 'r:gz'),
+    (('.tar.bz2', '.tbz2'), 'r:bz2'),
+    (('.tar',), 'r:'),
+]
+
+# memoized artifact manifests, by artifact path and mtime
+__MANIFESTS = {}
+
+
+def __normalize(name):
+    """Returns a tar member or file name as a `./`-prefixed relative path."""
+    return './' + os.path.normpath(name).lstrip('/')
+
+
+def can_read_artifact(artifact):
+    """Returns boolean indicating delta transfers can read the artifact's format or not."""
+    return any(artifact.endswith(extensions) for (extensions, _) in DELTA_READ_MODES)
+
+
+def open_artifact(artifact):
+    """Returns a `tarfile.TarFile` for reading the given local artifact."""
+    for (extensions, mode) in DELTA_READ_MODES:
+        if artifact.endswith(extensions):
+            return tarfile.open(artifact, mode)
+    raise Exception('Delta transfers do not support the format of [{}]!'.format(artifact))
+
+
+def get_artifact_manifest(artifact):
+    """Returns a dict of path -> (sha1, mode) for the regular files in a local artifact."""
+    key = (os.path.abspath(artifact), os.path.getmtime(artifact))
+    if key in __MANIFESTS:
+        return __MANIFESTS[key]
+
+    manifest = {}
+    with open_artifact(artifact) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            sha1 = hashlib.sha1()
+            src = tar.extractfile(member)
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                sha1.update(chunk)
+            manifest[__normalize(member.name)] = (sha1.hexdigest(), member.mode & 0o7777)
+
+    __MANIFESTS[key] = manifest
+    return manifest
+
+
+def write_manifest(manifest, filename):
+    """Writes an artifact's manifest to a file, as `<sha1> <octal mode> <path>`
+    lines. Paths with a newline in them are left out, so those files are
+    simply transferred."""
+    with open(filename, 'wb') as dest:
+        for (name, (sha1, mode)) in sorted(manifest.items()):
+            if '\n' not in name:
+                dest.write('{} {:o} {}\n'.format(sha1, mode, name))
+
+
+def parse_remote_manifests(output):
+    """Parses the output of the remote manifest script.
+
+    Lines are either `D <release> <dir>` (where the release lives) or
+    `F <release> <sha1> <octal mode> <path>` (from the release's manifest
+    file, see `write_manifest`).
+
+    Returns:
+        a tuple of a dict of release name -> dir, and a dict of
+        release name -> {path: (sha1, mode)}
+    """
+    dirs = {}
+    manifests = {}
+    for line in output.splitlines():
+        if line.startswith('D '):
+            (_, release, release_dir) = line.split(' ', 2)
+            dirs[release] = release_dir
+            continue
+        parts = line.split(' ', 4)
+        if len(parts) != 5 or parts[0] != 'F':
+            continue
+        (_, release, sha1, mode, name) = parts
+        manifests.setdefault(release, {})[__normalize(name)] = (sha1, int(mode, 8))
+    return (dirs, manifests)
+
+
+def plan_delta(manifest, remote_manifests, releases=('curr', 'prev')):
+    """Works out which of an artifact's files each host release already has.
+
+    Args:
+        manifest: the artifact's manifest, from `get_artifact_manifest`.
+        remote_manifests: the host's manifests, from `parse_remote_manifests`.
+        releases: (optional) the releases to link from, in order of preference.
+
+    Returns:
+        a dict of release name -> list of paths to hardlink from it
+    """
+    links = dict((release, []) for release in releases)
+    for (name, entry) in manifest.items():
+        for release in releases:
+            if remote_manifests.get(release, {}).get(name) == entry:
+                links[release].append(name)
+                break
+    return links
+
+
+def write_delta_artifact(artifact, links, delta_artifact):
+    """Writes a gzipped tarball of everything in `artifact` except the regular
+    files being hardlinked on the host. Directories, symlinks and the like
+    are always included.
+
+    Args:
+        artifact: the path to the full local artifact.
+        links: the paths being hardlinked, from `plan_delta`.
+        delta_artifact: the path to write the delta artifact to.
+
+    Returns:
+        a tuple of the number of files and bytes in the delta artifact
+    """
+    linked = set()
+    for names in links.values():
+        linked.update(names)
+
+    num_files = 0
+    num_bytes = 0
+    with open_artifact(artifact) as src:
+        with tarfile.open(delta_artifact, 'w:gz') as dest:
+            for member in src:
+                if member.isfile():
+                    if __normalize(member.name) in linked:
+                        continue
+                    dest.addfile(member, src.extractfile(member))
+                    num_files += 1
+                    num_bytes += member.size
+                else:
+                    dest.addfile(member)
+
+    return (num_files, num_bytes)
+
+
+def write_link_list(names, filename):
+    """Writes a NUL-separated list of paths, for `xargs -0` on the host."""
+    with open(filename, 'wb') as dest:
+        for name in sorted(names):
+            dest.write(name + b'\0')
@@ -0,0 +1,329 @@
+"""Distribution of an artifact to many hosts through a tree of peer relays
+
+Rather than the deployer uploading the artifact to every host, it uploads
+it to a few seed hosts. Every host that has the artifact then relays it on
+to a few that don't, over the private network, so the number of hosts that
+have it multiplies each round. Every hop is checked against the artifact's
+checksum.
+
+Relays are SSH connections from host to host as the deploying user, with a
+keypair made for the run. Its public key is only authorized to run the
+script that receives the artifact, and is removed from every host at the
+end of the run. Peers' host keys are read from each host over the
+deployer's own connection up front, and checked on every relay.
+"""
+
+from os import path
+import pipes
+import shutil
+import subprocess
+from tempfile import mkdtemp
+
+from fabric.api import env, execute, hide, put, run, settings
+
+from . import artifacts, tasks, timing
+from . import get_temp_dir
+
+
+# hosts seeded by the deployer, and hosts each host relays to per round;
+# `fanout_seeds` and `fanout_degree` in the `env` section of `config.yml`
+# override them
+FANOUT_SEEDS = 2
+FANOUT_DEGREE = 2
+
+# relays tried per host before uploading to it from the deployer instead
+FANOUT_MAX_ATTEMPTS = 2
+
+# the run's relay key, the script it may run, and the peers' host keys, by
+# file name in the app's temp dir on each host
+RELAY_KEY = '.relay-key'
+RELAY_RECEIVER = '.relay-receive.sh'
+RELAY_KNOWN_HOSTS = '.relay-known-hosts'
+
+# relays must never prompt, forward anything, or trust an unknown host key
+RELAY_SSH_OPTIONS = ('-a -o BatchMode=yes -o IdentitiesOnly=yes -o StrictHostKeyChecking=yes '
+                     '-o ConnectTimeout=10 -o LogLevel=ERROR')
+
+# Run on every host as the deploying user: installs the script the relay key
+# may run, authorizes the relay key for it alone, and reports the host's own
+# host keys as `HOSTKEY type key` lines.
+AUTHORIZE_SCRIPT = '''set -e
+umask 077
+cat > {receiver_path} <<'RECEIVER'
+{receiver}
+RECEIVER
+mkdir -p ~/.ssh
+echo '{authorized_key}' >> ~/.ssh/authorized_keys
+for key in /etc/ssh/ssh_host_*_key.pub; do
+    echo "HOSTKEY $(cut -d ' ' -f 1,2 "$key")"
+done
+'''
+
+# Run on a receiving host, as the relay key's forced command: writes the
+# artifact to a part file, and only moves it into place if its checksum
+# matches.
+RECEIVE_SCRIPT = '''set -e
+cat > {part_path}
+echo "{checksum}  {part_path}" | sha1sum -c --status
+mv {part_path} {artifact_path}'''
+
+# Run on a relaying host: sends the artifact to each target at once, and
+# reports a `RELAY target=ok|failed` line per target.
+RELAY_SCRIPT = '''cat > {known_hosts_path} <<'KNOWN_HOSTS'
+{known_hosts}
+KNOWN_HOSTS
+for target in {targets}; do
+    (ssh {ssh_options} -i {key_path} -o UserKnownHostsFile={known_hosts_path} \\
+        {user}@$target < {artifact_path} \\
+        && echo "RELAY $target=ok" || echo "RELAY $target=failed") &
+done
+wait
+'''
+
+# Run on every host at the end of the run: de-authorizes the relay key, and
+# removes its files.
+CLEANUP_SCRIPT = '''if [ -f ~/.ssh/authorized_keys ]; then
+    grep -v -F '{key_comment}' ~/.ssh/authorized_keys > ~/.ssh/.authorized_keys.relay || true
+    cat ~/.ssh/.authorized_keys.relay > ~/.ssh/authorized_keys
+    rm -f ~/.ssh/.authorized_keys.relay
+fi
+rm -f {key_path} {receiver_path} {known_hosts_path}
+'''
+
+
+def __get_temp_path(app_name, filename):
+    """Returns the path to a file in the app's temp dir on a host."""
+    return '{}/{}'.format(get_temp_dir(app_name), filename)
+
+
+def __is_artifact_valid(app_name, artifact, checksum):
+    """Returns boolean indicating the host has the artifact, with the right checksum."""
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = run('echo "{}  {}" | sha1sum -c --status'.format(
+            checksum, __get_temp_path(app_name, artifact)))
+    return out.succeeded
+
+
+def make_relay_key(key_dir):
+    """Makes a keypair for the run's relays in `key_dir`.
+
+    Returns:
+        a tuple of the private key's path, and the public key's line, which
+        ends with a comment unique to the run
+    """
+    import uuid
+
+    key_file = path.join(key_dir, 'relay_key')
+    comment = 'deploytool-relay-{}'.format(uuid.uuid4().hex)
+    subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-b', '2048', '-N', '',
+                           '-C', comment, '-f', key_file])
+    with open(key_file + '.pub') as public_key:
+        return (key_file, public_key.read().strip())
+
+
+def prepare_host(app_name, artifact, checksum, key_file, public_key, seed_hosts):
+    """Readies the host for the run's relays: uploads the artifact to it if
+    it's a seed host (otherwise just empties the temp dir), and installs and
+    authorizes the relay key.
+
+    Args:
+        app_name: The name of the app the artifact is for.
+        artifact: The artifact's filename.
+        checksum: The artifact's sha1 checksum.
+        key_file: The path to the relay key, from `make_relay_key`.
+        public_key: The relay key's public key line.
+        seed_hosts: The hosts the deployer uploads the artifact to.
+
+    Returns:
+        a dict with whether the host was `seeded` with a valid copy of the
+        artifact, and its `host_keys` as `type key` strings
+    """
+    seeded = env.host_string in seed_hosts
+    if seeded:
+        tasks.upload_build_artifact(artifact, app_name)
+    else:
+        tasks.prepare_temp_dir(app_name)
+
+    receiver_path = __get_temp_path(app_name, RELAY_RECEIVER)
+    put(key_file, __get_temp_path(app_name, RELAY_KEY), mode=0600)
+    with settings(hide('running', 'stdout')):
+        out = run(AUTHORIZE_SCRIPT.format(
+            receiver_path=receiver_path,
+            receiver=RECEIVE_SCRIPT.format(
+                part_path=__get_temp_path(app_name, '.{}.part'.format(artifact)),
+                artifact_path=__get_temp_path(app_name, artifact),
+                checksum=checksum),
+            authorized_key='command="sh {}",no-agent-forwarding,no-port-forwarding,'
+                           'no-pty,no-X11-forwarding {}'.format(receiver_path, public_key)))
+
+    return {
+        'seeded': seeded and __is_artifact_valid(app_name, artifact, checksum),
+        'host_keys': [line[len('HOSTKEY '):].strip() for line in out.stdout.splitlines()
+                      if line.startswith('HOSTKEY ')],
+    }
+
+
+def relay_artifact(app_name, artifact, assignments, host_keys):
+    """Relays the artifact from the host to the hosts assigned to it, at once.
+
+    Args:
+        app_name: The name of the app the artifact is for.
+        artifact: The artifact's filename.
+        assignments: A dict of relaying host -> list of hosts to relay to.
+        host_keys: A dict of host -> list of its host keys, as `type key`.
+
+    Returns:
+        a dict of target host -> boolean indicating it received a valid copy
+    """
+    targets = assignments[env.host_string]
+    known_hosts = ['{} {}'.format(target, key)
+                   for target in targets for key in host_keys.get(target, [])]
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True), \
+            timing.span('relay', targets=len(targets)):
+        out = run(RELAY_SCRIPT.format(
+            known_hosts_path=__get_temp_path(app_name, RELAY_KNOWN_HOSTS),
+            known_hosts='\n'.join(known_hosts),
+            targets=' '.join(pipes.quote(target) for target in targets),
+            ssh_options=RELAY_SSH_OPTIONS,
+            key_path=__get_temp_path(app_name, RELAY_KEY),
+            user=env.user,
+            artifact_path=__get_temp_path(app_name, artifact)))
+
+    results = {target: False for target in targets}
+    for line in out.stdout.splitlines():
+        if line.startswith('RELAY '):
+            (target, _, result) = line[len('RELAY '):].strip().rpartition('=')
+            if target in results:
+                results[target] = result == 'ok'
+    return results
+
+
+def cleanup_host(app_name, public_key):
+    """De-authorizes the run's relay key on the host, and removes its files."""
+    with settings(hide('running', 'stdout')):
+        run(CLEANUP_SCRIPT.format(
+            key_comment=public_key.split()[-1],
+            key_path=__get_temp_path(app_name, RELAY_KEY),
+            receiver_path=__get_temp_path(app_name, RELAY_RECEIVER),
+            known_hosts_path=__get_temp_path(app_name, RELAY_KNOWN_HOSTS)))
+
+
+def plan_round(holders, pending, degree):
+    """Assigns up to `degree` of the `pending` hosts to each of the `holders`.
+
+    Returns:
+        a dict of relaying host -> list of hosts to relay to
+    """
+    assignments = {}
+    for (num, holder) in enumerate(holders):
+        targets = pending[num * degree:(num + 1) * degree]
+        if targets:
+            assignments[holder] = targets
+    return assignments
+
+
+def distribute_artifact(app_name, artifact_uri, hosts, seeds=None, degree=None):
+    """Puts the local artifact into the app's temp dir on every host, by seeding a
+    few hosts and relaying from host to host in rounds. Hosts the relays can't
+    reach after `FANOUT_MAX_ATTEMPTS` tries are uploaded to directly.
+
+    Args:
+        app_name: The name of the app the artifact is for.
+        artifact_uri: The URI of the artifact, already fetched locally.
+        hosts: The hosts to distribute the artifact to.
+        seeds: (optional) The number of hosts the deployer uploads to.
+        degree: (optional) The number of hosts each host relays to per round.
+
+    Returns:
+        a dict with the number of hosts `seeded`, `relayed` to, and `uploaded`
+        to directly, and the number of relay `rounds`
+    """
+    artifact = path.basename(artifact_uri)
+    checksum = artifacts.get_artifact_checksum(artifact)
+    seeds = max(1, int(seeds or env.get('fanout_seeds', FANOUT_SEEDS)))
+    degree = max(1, int(degree or env.get('fanout_degree', FANOUT_DEGREE)))
+    hosts = list(hosts)
+
+    key_dir = mkdtemp()
+    try:
+        (key_file, public_key) = make_relay_key(key_dir)
+
+        print "Seeding [{}] to {}...".format(artifact, hosts[:seeds])
+        with settings(hide('running', 'stdout'), parallel=True,
+                      pool_size=tasks.get_pool_size(), warn_only=True, skip_bad_hosts=True):
+            prepared = execute(prepare_host, app_name, artifact, checksum, key_file,
+                               public_key, hosts[:seeds], hosts=hosts)
+        prepared = {host: prepared[host] for host in hosts
+                    if isinstance(prepared.get(host), dict)}
+
+        try:
+            result = __relay_rounds(app_name, artifact, hosts, seeds, degree, prepared)
+        finally:
+            with settings(hide('running', 'stdout'), parallel=True,
+                          pool_size=tasks.get_pool_size(), warn_only=True,
+                          skip_bad_hosts=True):
+                execute(cleanup_host, app_name, public_key, hosts=sorted(prepared))
+    finally:
+        shutil.rmtree(key_dir)
+
+    print ("Distributed [{}] to [{}] hosts: [{seeded}] seeded, [{relayed}] relayed in "
+           "[{rounds}] rounds, [{uploaded}] uploaded directly.").format(artifact, len(hosts),
+                                                                        **result)
+    return result
+
+
+def __relay_rounds(app_name, artifact, hosts, seeds, degree, prepared):
+    """Relays the artifact from the seeded hosts to the other prepared hosts in
+    rounds, then uploads it to any hosts the relays couldn't reach.
+
+    Returns:
+        a dict like `distribute_artifact`'s
+    """
+    host_keys = {host: prepared[host]['host_keys'] for host in prepared}
+    seed_hosts = [host for host in hosts[:seeds] if prepared.get(host, {}).get('seeded')]
+    holders = list(seed_hosts)
+    pending = [host for host in hosts if host in prepared and host not in seed_hosts]
+    attempts = {}
+    unreachable = [host for host in hosts if host not in prepared]
+    rounds = 0
+
+    while pending and holders:
+        assignments = plan_round(holders, pending, degree)
+        rounds += 1
+        print "Relay round [{}]: [{}] hosts relaying to [{}] hosts...".format(
+            rounds, len(assignments), sum(len(targets) for targets in assignments.values()))
+
+        with settings(hide('running', 'stdout'), parallel=True,
+                      pool_size=tasks.get_pool_size(), warn_only=True, skip_bad_hosts=True):
+            relayed = execute(relay_artifact, app_name, artifact, assignments, host_keys,
+                              hosts=sorted(assignments))
+
+        for (holder, targets) in sorted(assignments.items()):
+            results = relayed.get(holder)
+            if not isinstance(results, dict):
+                results = {}
+            for target in targets:
+                pending.remove(target)
+                if results.get(target):
+                    holders.append(target)
+                    continue
+                attempts[target] = attempts.get(target, 0) + 1
+                if attempts[target] < FANOUT_MAX_ATTEMPTS:
+                    pending.append(target)
+                else:
+                    unreachable.append(target)
+
+    # anything the relays couldn't reach gets the artifact from the deployer
+    uploaded = unreachable + pending
+    if uploaded:
+        print "WARNING: relaying to {} failed, uploading directly!".format(uploaded)
+        with settings(parallel=True, pool_size=tasks.get_pool_size()):
+            execute(tasks.upload_build_artifact, artifact, app_name, hosts=uploaded)
+
+    return {
+        'seeded': len(seed_hosts),
+        'relayed': len(holders) - len(seed_hosts),
+        'uploaded': len(uploaded),
+        'rounds': rounds,
+    }
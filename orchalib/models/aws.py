@@ -6,6 +6,8 @@ class Ec2Instance(object):
 
     """
 
+    __slots__ = ('instance_id', 'instance_ip', 'tags', 'apps')
+
     def __init__(self, instance_id, instance_ip, tags):
         self.instance_id = instance_id
         self.instance_ip = instance_ip
@@ -14,6 +16,12 @@ class Ec2Instance(object):
         for tag in tags:
             self.tags[tag['Key']] = tag['Value']
 
+        # parse the `Apps` tag once, rather than on every `has_app` call
+        if 'Apps' in self.tags:
+            self.apps = frozenset(self.tags['Apps'].split(','))
+        else:
+            self.apps = frozenset()
+
     def __str__(self):
         return "%s, %s, %s" % (self.instance_id, self.instance_ip, repr(self.tags))
 
@@ -22,9 +30,59 @@ class Ec2Instance(object):
         app by examining the instance tags
 
         """
-        try:
-            appstr = self.tags['Apps']
-            applist = appstr.split(',')
-            return app in applist
-        except KeyError:
-            return False
+        return app in self.apps
+
+
+class Ec2InstanceCollection(object):
+    """A list of Ec2Instance objects, with a precomputed index of app name
+    to the instances associated with that app
+
+    """
+
+    __slots__ = ('instances', 'app_index')
+
+    def __init__(self, instances):
+        self.instances = list(instances)
+
+        self.app_index = {}
+        for instance in self.instances:
+            for app in instance.apps:
+                self.app_index.setdefault(app, []).append(instance)
+
+    def __iter__(self):
+        return iter(self.instances)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __getitem__(self, index):
+        return self.instances[index]
+
+    def for_app(self, app):
+        """Returns a list of the instances associated with the given app."""
+        return list(self.app_index.get(app, []))
+
+
+class ElbRegistration(object):
+    """Contains the outcome of registering an EC2 instance in an ELB,
+    including its last known health state and how long it took to get there
+
+    """
+
+    __slots__ = ('instance_id', 'load_balancer_name', 'state', 'seconds', 'error')
+
+    def __init__(self, instance_id, load_balancer_name):
+        self.instance_id = instance_id
+        self.load_balancer_name = load_balancer_name
+        self.state = 'Unknown'
+        self.seconds = None
+        self.error = None
+
+    def __str__(self):
+        return "%s, %s, %s, %s" % (self.instance_id, self.load_balancer_name, self.state,
+                                   self.error or '%.1fs' % (self.seconds or 0))
+
+    @property
+    def healthy(self):
+        """Determine if the instance became healthy in the ELB"""
+        return self.error is None and self.state == 'InService'
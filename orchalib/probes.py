@@ -0,0 +1,100 @@
+"""Direct HTTP readiness probes of instances, ahead of ELB re-registration"""
+
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Lock
+from time import sleep, time
+
+from orchalib import is_response_valid, timing
+
+
+# polling schedule (in seconds) while waiting for instances to answer their
+# health check URL, the timeout of each request, and the max time to wait
+PROBE_INTERVAL = 0.5
+PROBE_TIMEOUT = 2.0
+PROBE_MAX_WAIT = 120
+
+# max number of hosts the probe session keeps connections to
+PROBE_POOL_SIZE = 100
+
+# requests sessions, keyed by process id like the boto3 clients (see `aws.get_client`)
+__SESSIONS = {}
+__SESSIONS_LOCK = Lock()
+
+
+def get_session():
+    """Returns the requests session shared by all probes in this process, so
+    that each host's connection is kept alive between probes."""
+    import requests
+
+    pid = os.getpid()
+    with __SESSIONS_LOCK:
+        if pid not in __SESSIONS:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=PROBE_POOL_SIZE,
+                                                    pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            __SESSIONS[pid] = session
+        return __SESSIONS[pid]
+
+
+def __probe(url, deadline):
+    """Polls `url` until it answers with a 2xx, or `deadline` has passed.
+
+    Returns:
+        a string describing the last failure, or None if the URL answered
+    """
+    import requests
+
+    session = get_session()
+    while True:
+        try:
+            res = session.get(url, timeout=PROBE_TIMEOUT, allow_redirects=False)
+            if is_response_valid(res):
+                return None
+            error = 'HTTP {}'.format(res.status_code)
+        except requests.RequestException as err:
+            error = err.__class__.__name__
+
+        if time() >= deadline:
+            return error
+        sleep(min(PROBE_INTERVAL, max(deadline - time(), 0)))
+
+
+def wait_until_ready(instances, url, max_wait=PROBE_MAX_WAIT):
+    """Probes a wave of instances at once, until each answers its health check
+    URL with a 2xx or `max_wait` seconds have passed.
+
+    Args:
+        instances: The Ec2Instances to probe.
+        url: The health check URL, with `{ip}` in place of the instance's IP,
+             i.e. 'http://{ip}:8080/health'.
+        max_wait: (optional) Max seconds to wait for instances to answer.
+
+    Returns:
+        a list of the Ec2Instances that didn't answer in time
+    """
+    start = time()
+    deadline = start + max_wait
+
+    def probe(instance):
+        error = __probe(url.format(ip=instance.instance_ip), deadline)
+        timing.record('probe', start, time(), host=instance.instance_ip,
+                      instance_id=instance.instance_id, failed=error is not None)
+        if error is None:
+            print "Instance [{}] ready after [{:.1f}] seconds.".format(instance.instance_id,
+                                                                      time() - start)
+        else:
+            print "WARNING: Instance [{}] not ready after [{}] seconds ({})!".format(
+                instance.instance_id, max_wait, error)
+        return error
+
+    print "Probing instances {} at [{}]...".format([i.instance_id for i in instances], url)
+    pool = ThreadPool(max(1, len(instances)))
+    try:
+        errors = pool.map(probe, instances)
+    finally:
+        pool.close()
+
+    return [i for (i, error) in zip(instances, errors) if error is not None]
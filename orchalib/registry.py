@@ -0,0 +1,57 @@
+"""Registry of the deploy recipes in the `recipes` package, imported on demand"""
+
+from importlib import import_module
+import os
+
+
+# the package that recipes are modules of
+RECIPES_PACKAGE = 'recipes'
+
+# recipe name -> module path, per recipes dir, with the dir's mtime when indexed
+__INDEXES = {}
+
+
+def get_recipes_dir():
+    """Returns the directory of the recipes package, without importing any recipes."""
+    return os.path.dirname(import_module(RECIPES_PACKAGE).__file__)
+
+
+def get_recipe_index(recipes_dir=None):
+    """Returns a dict of recipe name -> module path. The directory is only
+    re-scanned when its mtime changes, i.e. when a recipe is added or removed.
+
+    Args:
+        recipes_dir: (optional) The directory to index. (default=the recipes package)
+    """
+    recipes_dir = recipes_dir or get_recipes_dir()
+    mtime = os.stat(recipes_dir).st_mtime
+
+    if recipes_dir not in __INDEXES or __INDEXES[recipes_dir][0] != mtime:
+        index = {}
+        for filename in os.listdir(recipes_dir):
+            (name, ext) = os.path.splitext(filename)
+            if ext == '.py' and not name.startswith('_'):
+                index[name] = os.path.join(recipes_dir, filename)
+        __INDEXES[recipes_dir] = (mtime, index)
+
+    return __INDEXES[recipes_dir][1]
+
+
+def list_recipes():
+    """Returns a sorted list of the names of all recipes."""
+    return sorted(get_recipe_index())
+
+
+def load_recipe(app_name):
+    """Imports the recipe for the given app, and none of the others. A recipe
+    is imported once per process; later lookups return the same module.
+
+    Args:
+        app_name: The name of the app/recipe.
+
+    Returns:
+        the recipe module, or None if there's no recipe for the app
+    """
+    if app_name not in get_recipe_index():
+        return None
+    return import_module('{}.{}'.format(RECIPES_PACKAGE, app_name))
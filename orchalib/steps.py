@@ -0,0 +1,175 @@
+"""Declarative recipe steps, run as soon as the steps they require are done
+
+A recipe declares its steps and what each requires, instead of a fixed
+chain of `execute` calls:
+
+    run_steps([
+        Step('fetch', tasks.local_fetch_s3_artifact, uri),
+        Step('release', tasks.deploy_artifact, app_name, uri, requires=['fetch']),
+        Step('config', tasks.create_symlink, src, dest, requires=['release']),
+        Step('warmup', warm_cache, requires=['release']),
+        Step('restart', tasks.service_restart, app_name, requires=['config']),
+    ])
+
+Steps whose requirements are done run at the same time. Fabric's `env`,
+output settings and connections are global to a process, so steps that run
+side by side each run in a forked process, like fabric's parallel workers:
+their return values must be picklable, and anything else they change in the
+process (i.e. memoized results) is gone once they're done. A step that is
+the only one that can run, or every step with a `concurrency` of 1, runs in
+the host's own process.
+"""
+
+from multiprocessing import Process, Queue
+from Queue import Empty
+import sys
+import traceback
+
+from fabric import state
+
+
+# max number of steps run at the same time on a host
+STEP_CONCURRENCY = 4
+
+
+class Step(object):
+    """A named unit of work: a function and its arguments, plus the names of
+    the steps that must be done before it can start (the `requires` kwarg).
+
+    """
+
+    __slots__ = ('name', 'func', 'args', 'kwargs', 'requires')
+
+    def __init__(self, name, func, *args, **kwargs):
+        self.name = name
+        self.func = func
+        self.requires = tuple(kwargs.pop('requires', ()))
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return "%s (requires %s)" % (self.name, ', '.join(self.requires) or 'nothing')
+
+
+def check_steps(steps):
+    """Raises an Exception if step names aren't unique, or a step requires a
+    step that doesn't exist or (indirectly) itself."""
+    names = [step.name for step in steps]
+    for step in steps:
+        if names.count(step.name) > 1:
+            raise Exception('Step [{}] is declared more than once!'.format(step.name))
+        for name in step.requires:
+            if name not in names:
+                raise Exception('Step [{}] requires unknown step [{}]!'.format(step.name, name))
+
+    # peel off steps whose requirements are all peeled off; any left are in a cycle
+    remaining = list(steps)
+    done = set()
+    while remaining:
+        ready = [step for step in remaining if done.issuperset(step.requires)]
+        if not ready:
+            raise Exception('Steps {} require each other!'.format(
+                [step.name for step in remaining]))
+        for step in ready:
+            remaining.remove(step)
+            done.add(step.name)
+
+
+def __run_forked_step(step, completed):
+    """Runs a step in a forked process, and reports its result, or the
+    exception it raised, to the parent."""
+    # like fabric's parallel workers, never use the parent's SSH connections
+    state.connections.clear()
+    try:
+        completed.put((step.name, True, step.func(*step.args, **step.kwargs)))
+    except BaseException as err:
+        sys.stderr.write("!!! Step [{}] failed:\n{}".format(step.name, traceback.format_exc()))
+        completed.put((step.name, False, err))
+
+
+def __get_exit_failures(running, completed):
+    """Returns (name, False, Exception) for each forked step that exited
+    without reporting a result, once the results it could have reported
+    have been read."""
+    exited = [name for (name, process) in running.items() if not process.is_alive()]
+    if not exited:
+        return []
+
+    # a step's result is sent before its process exits, so read any in flight first
+    results = []
+    try:
+        while True:
+            results.append(completed.get(True, 0.1))
+    except Empty:
+        pass
+    reported = set(result[0] for result in results)
+    for name in exited:
+        if name not in reported:
+            results.append((name, False, Exception('Step [{}] exited with status [{}]!'.format(
+                name, running[name].exitcode))))
+    return results
+
+
+def run_steps(steps, concurrency=STEP_CONCURRENCY):
+    """Runs steps on the current host, each as soon as the steps it requires
+    are done, and up to `concurrency` at a time. Steps that are ready at the
+    same time start in the order they were declared.
+
+    If a step fails, no more steps are started; the ones already running are
+    waited for, then the first failure is re-raised.
+
+    Args:
+        steps: A list of Step.
+        concurrency: (optional) Max number of steps run at the same time.
+
+    Returns:
+        a dict of step name -> the step's return value
+    """
+    check_steps(steps)
+
+    pending = list(steps)
+    running = {}
+    results = {}
+    failure = None
+    completed = Queue()
+
+    while pending or running:
+        ready = []
+        if failure is None:
+            ready = [s for s in pending if all(r in results for r in s.requires)]
+
+        # a step with nothing to run beside it runs right here
+        if ready and not running and (len(ready) == 1 or int(concurrency) <= 1):
+            step = ready[0]
+            pending.remove(step)
+            try:
+                results[step.name] = step.func(*step.args, **step.kwargs)
+            except BaseException:
+                failure = sys.exc_info()
+            continue
+
+        for step in ready[:max(0, max(1, int(concurrency)) - len(running))]:
+            pending.remove(step)
+            running[step.name] = Process(target=__run_forked_step, args=(step, completed))
+            running[step.name].start()
+
+        if not running:
+            break
+
+        # poll, so that a KeyboardInterrupt isn't held up by the wait
+        try:
+            outcomes = [completed.get(True, 1)]
+        except Empty:
+            outcomes = __get_exit_failures(running, completed)
+
+        for (name, succeeded, value) in outcomes:
+            running.pop(name).join()
+            if succeeded:
+                results[name] = value
+            elif failure is None:
+                failure = (value.__class__, value, None)
+
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
+
+    return results
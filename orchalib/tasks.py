@@ -1,47 +1,382 @@
 """Helper routines that can be executed from tasks"""
 
 from os import path
+import pipes
+import shutil
+import socket
+from tempfile import mkdtemp
+from time import time
 
-from fabric.api import env, execute, local, put, sudo
-from fabric.context_managers import cd
-from fabric.decorators import runs_once
-from fabric.contrib import files
+from fabric.api import env, execute, hide, put, settings, sudo
+from fabric.state import connections
 
+from . import artifacts, aws, delta, timing
+from .steps import Step, run_steps
 from . import (
     DEFAULT_OWNER,
     get_current_release_dir,
+    get_release_store_dir,
+    get_staging_release_dir,
     get_temp_dir,
     get_app_basedir
 )
 
 
-@runs_once
+# How artifacts get onto hosts, unless overridden per call:
+#   upload - `put` the artifact into the temp dir, then extract it there.
+#   stream - pipe the artifact over the SSH channel straight into `tar -x`,
+#            so upload and decompression overlap (needs passwordless sudo).
+#            Staging always extracts, since nothing is left in the temp dir.
+#   delta  - only upload the files the host's current/prev releases don't
+#            already have, and hardlink the rest into the new release. Only
+#            .tar(.gz|.bz2) artifacts; others are transferred as with upload.
+#   fanout - when staging, upload the artifact to a few hosts only, which
+#            relay it on to the rest (see `orchalib.fanout`); otherwise the
+#            same as upload.
+# Set `artifact_transfer` in the `env` section of `config.yml` to change it.
+DEFAULT_ARTIFACT_TRANSFER = 'upload'
+
+# Max number of hosts fabric connects to at once when a step runs on many
+# hosts in parallel, so that bastions and sshd's `MaxStartups` aren't
+# overwhelmed. Set `pool_size` in the `env` section of `config.yml` to change it.
+DEFAULT_POOL_SIZE = 20
+
+# opt-in store of releases on each host, keyed by artifact checksum (see
+# `enable_release_store`), so redeploying a build the host has kept is just
+# a symlink switch
+RELEASE_STORE = {
+    'retention': None,
+}
+
+# (uri, local dest) -> local filename of the artifacts fetched by this process
+__FETCHED_ARTIFACTS = {}
+
+# bytes sent to the SSH channel at a time when streaming an artifact
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Commands that decompress an artifact to a tar stream on stdout, by artifact
+# file extension. `{}` is the artifact's path, or empty to read from stdin.
+# Parallel decompressors are used when the host has them.
+ARTIFACT_DECOMPRESSORS = [
+    (('.tar.gz', '.tgz'), '$(command -v pigz || echo gzip) -dc {}'),
+    (('.tar.zst', '.tar.zstd', '.tzst'), 'zstd -dc {}'),
+    (('.tar.xz', '.txz'), 'xz -dc {}'),
+    (('.tar.bz2', '.tbz2'), '$(command -v pbzip2 || echo bzip2) -dc {}'),
+    (('.tar',), 'cat {}'),
+]
+
+# Pre-extracts an uploaded artifact into the staging release directory.
+STAGE_SCRIPT = '''set -e -o pipefail
+rm -rf {staging_dir}
+if [ {extract} = 1 ]; then
+    mkdir -p {staging_dir}
+    chown {owner} {staging_dir}
+    {decompress} | {as_owner} tar -C {staging_dir}/ -xpf - --no-same-owner
+fi
+'''
+
+# Lists the releases a delta can be built against, with the manifest of their
+# files written when they were built: the one 'current' points at (offered as
+# 'curr'), and 'prev'. A release built without a manifest offers no files.
+MANIFEST_SCRIPT = '''set -e -o pipefail
+target={curr_dir}
+if [ -L {current_sym} ]; then
+    target=$(readlink {current_sym})
+fi
+if [ "$target" = {prev_dir} ]; then
+    target={curr_dir}
+fi
+for release in "curr=$target" "prev={prev_dir}"; do
+    name=${{release%%=*}}
+    dir=${{release#*=}}
+    if [ -d "$dir" ]; then
+        echo "D $name $dir"
+        if [ -f "$dir/{manifest}" ]; then
+            sed "s|^|F $name |" "$dir/{manifest}"
+        fi
+    fi
+done
+'''
+
+# Builds a release in the staging dir from hardlinks into the existing
+# releases plus a delta artifact holding everything else, along with the
+# manifest of the full artifact for the next delta to be planned from.
+DELTA_SCRIPT = '''set -e -o pipefail
+rm -rf {staging_dir}
+mkdir -p {staging_dir}
+chown {owner} {staging_dir}
+{link_commands}
+{decompress} | {as_owner} tar -C {staging_dir}/ -xpf - --no-same-owner
+cp {temp_dir}/{manifest} {staging_dir}/{manifest}
+chown {owner} {staging_dir}/{manifest}
+'''
+
+# Rotates releases and switches the 'current' symlink in one round-trip:
+# - if 'current' exists it must be a symlink, and the new release goes
+#   where it points (normally 'curr');
+# - the new release is built in the staging dir, unless it was staged there
+#   already, by extracting the artifact as its owner;
+# - 'prev' is deleted and the old release moved there, unless 'current' was
+#   rolled back to 'prev': then 'prev' is kept as the release to roll back
+#   to, and the new release replaces the rolled-back one in 'curr';
+# - the new release is renamed into place, and 'current' re-pointed at it
+#   by renaming a new symlink over it; the temp dir is removed.
+# Releases are never written to in place, since a delta release shares
+# hardlinked files with the releases it was built from.
+RELEASE_SCRIPT = '''set -e -o pipefail
+deploy_dir={curr_dir}
+if [ -e {current_sym} ]; then
+    if [ -L {current_sym} ]; then
+        deploy_dir=$(readlink {current_sym})
+    else
+        echo "[{current_sym}] is not a symlink?!?"
+        exit 3
+    fi
+fi
+pre_extracted=0
+if [ {staged} = 1 ] && [ -e {staging_dir} ]; then
+    pre_extracted=1
+else
+    rm -rf {staging_dir}
+    mkdir -p {staging_dir}
+    chown {owner} {staging_dir}
+    {decompress} | {as_owner} tar -C {staging_dir}/ -xpf - --no-same-owner
+fi
+rotated=0
+if [ "$deploy_dir" = {prev_dir} ]; then
+    deploy_dir={curr_dir}
+    rm -rf "$deploy_dir"
+else
+    rm -rf {prev_dir}
+    if [ -e "$deploy_dir" ]; then
+        mv "$deploy_dir" {prev_dir}
+        rotated=1
+    fi
+fi
+mv {staging_dir} "$deploy_dir"
+ln -sfn "$deploy_dir" {current_sym}.next
+mv -T {current_sym}.next {current_sym}
+rm -rf {temp_dir}
+echo "RELEASE deploy_dir=$deploy_dir"
+echo "RELEASE rotated=$rotated"
+echo "RELEASE pre_extracted=$pre_extracted"
+'''
+
+# Deploys a release into the host's release store instead of curr/prev:
+# - if the store has the release for this checksum already, it's reused as is;
+# - otherwise it's moved in from the staging dir if it was staged, or
+#   extracted from the artifact as its owner;
+# - 'current' is switched to it, and 'prev' to the release it replaces, by
+#   renaming new symlinks over them; a curr/prev directory 'current' was at
+#   before the store was enabled is moved into the store to be that release;
+# - all but the most recently deployed releases, up to the retention count,
+#   are deleted, except the ones 'current' and 'prev' point at.
+# Releases are extracted to a dot dir first, so that a partial extraction
+# is never mistaken for a release. A release's mtime is when it was last
+# deployed.
+STORE_RELEASE_SCRIPT = '''set -e -o pipefail
+release_dir={store_dir}/{checksum}
+if [ -e {current_sym} ] && [ ! -L {current_sym} ]; then
+    echo "[{current_sym}] is not a symlink?!?"
+    exit 3
+fi
+mkdir -p {store_dir}
+store_hit=0
+pre_extracted=0
+if [ -d "$release_dir" ]; then
+    store_hit=1
+    rm -rf {staging_dir}
+elif [ {staged} = 1 ] && [ -e {staging_dir} ]; then
+    pre_extracted=1
+    mv {staging_dir} "$release_dir"
+else
+    partial_dir={store_dir}/.{checksum}.partial
+    rm -rf "$partial_dir"
+    mkdir -p "$partial_dir"
+    chown {owner} "$partial_dir"
+    {decompress} | {as_owner} tar -C "$partial_dir"/ -xpf - --no-same-owner
+    mv "$partial_dir" "$release_dir"
+fi
+touch "$release_dir"
+rotated=0
+rotated_from=$(readlink {current_sym} || true)
+if [ "$rotated_from" != "$release_dir" ]; then
+    ln -sfn "$release_dir" {current_sym}.next
+    mv -T {current_sym}.next {current_sym}
+    if [ -n "$rotated_from" ]; then
+        rotated=1
+        # if the store was enabled after curr/prev deploys, 'current' was at one of
+        # those directories (either one, after a rollback): keep it in the store
+        case "$rotated_from" in
+            {store_dir}/*) ;;
+            *)
+                if [ -d "$rotated_from" ]; then
+                    kept_dir={store_dir}/$(basename "$rotated_from")-$(date +%s)
+                    mv -T "$rotated_from" "$kept_dir"
+                    rotated_from=$kept_dir
+                fi
+                ;;
+        esac
+        if [ ! -L {prev_dir} ]; then
+            rm -rf {prev_dir}
+        fi
+        ln -sfn "$rotated_from" {prev_dir}.next
+        mv -T {prev_dir}.next {prev_dir}
+    fi
+fi
+prev_release=$(readlink {prev_dir} || true)
+pruned=0
+for dir in $(ls -1dt {store_dir}/*/ | sed 's|/$||' | tail -n +$(({retention} + 1))); do
+    if [ "$dir" != "$release_dir" ] && [ "$dir" != "$prev_release" ]; then
+        rm -rf "$dir"
+        pruned=$((pruned + 1))
+    fi
+done
+rm -rf {temp_dir}
+echo "RELEASE deploy_dir=$release_dir"
+echo "RELEASE rotated=$rotated"
+echo "RELEASE pre_extracted=$pre_extracted"
+echo "RELEASE store_hit=$store_hit"
+echo "RELEASE pruned=$pruned"
+'''
+
+# Points 'current' back at the release it doesn't point at now: normally
+# 'prev', or 'curr' if 'current' was already rolled back to 'prev'. The new
+# symlink is renamed over 'current', so the switch is atomic. With the
+# release store, 'prev' is a symlink too, and the two are swapped. With
+# dry_run, only reports the release it would switch to.
+ROLLBACK_SCRIPT = '''set -e -o pipefail
+if [ ! -L {current_sym} ]; then
+    echo "[{current_sym}] is not a symlink?!?"
+    exit 3
+fi
+rolled_back_from=$(readlink {current_sym})
+if [ -L {prev_dir} ]; then
+    deploy_dir=$(readlink {prev_dir})
+elif [ "$rolled_back_from" = {prev_dir} ]; then
+    deploy_dir={curr_dir}
+else
+    deploy_dir={prev_dir}
+fi
+if [ ! -d "$deploy_dir" ]; then
+    echo "No release to roll back to at [$deploy_dir]!"
+    exit 4
+fi
+if [ {dry_run} = 0 ]; then
+    ln -sfn "$deploy_dir" {current_sym}.next
+    mv -T {current_sym}.next {current_sym}
+    if [ -L {prev_dir} ]; then
+        ln -sfn "$rolled_back_from" {prev_dir}.next
+        mv -T {prev_dir}.next {prev_dir}
+    fi
+fi
+echo "RELEASE deploy_dir=$deploy_dir"
+echo "RELEASE rolled_back_from=$rolled_back_from"
+'''
+
+
 def local_fetch_s3_artifact(uri, local_dest='.'):
     """Download a deployable from S3.
     Stages the S3 artifact locally on the deployer's system for later upload.
+    Each artifact is only fetched once per run; fabric's workers inherit the
+    fetched artifacts from the process that forked them.
 
     Args:
         uri: An S3 URI to the artifact for deployment
     """
-    local('aws s3 cp {} {}'.format(uri, local_dest))
-
-
+    if (uri, local_dest) in __FETCHED_ARTIFACTS:
+        return __FETCHED_ARTIFACTS[(uri, local_dest)]
+
+    with timing.span('fetch', host='localhost', uri=uri):
+        if artifacts.is_artifact_cache_enabled():
+            filename = artifacts.fetch_artifact(uri, local_dest)
+        else:
+            filename = aws.download_s3_artifact(uri, local_dest)
+
+    # checksum the artifact (and list its files for delta transfers) once,
+    # before fabric forks a worker per host
+    if is_release_store_enabled():
+        artifacts.get_artifact_checksum(filename)
+    if get_artifact_transfer() == 'delta':
+        if delta.can_read_artifact(filename):
+            delta.get_artifact_manifest(filename)
+        else:
+            print 'WARNING: delta transfers cannot read [{}], uploading it in full.'.format(
+                filename)
+
+    __FETCHED_ARTIFACTS[(uri, local_dest)] = filename
+    return filename
+
+
+@timing.timed('restart')
 def service_restart(appname):
     """Restart the specified service"""
     sudo('service {} restart'.format(appname))
 
 
 def create_symlink(src, dest):
-    """Create a symlink at `dest`, pointing to `src`."""
-    sudo('ln -s {} {}'.format(src, dest))
+    """Create a symlink at `dest`, pointing to `src`, replacing any existing
+    symlink, i.e. in a release reused from the release store."""
+    sudo('ln -sfn {} {}'.format(src, dest))
+
+
+def enable_release_store(retention=5):
+    """Turns on the release store on hosts; see `STORE_RELEASE_SCRIPT`.
+
+    Args:
+        retention: (optional) The number of most recently deployed releases
+                   to keep on each host.
+    """
+    RELEASE_STORE['retention'] = int(retention)
+
+
+def is_release_store_enabled():
+    """Returns boolean indicating the release store is enabled or not."""
+    return bool(RELEASE_STORE['retention'])
+
+
+def is_in_release_store(app_name, checksum):
+    """Returns boolean indicating the host's release store has the release
+    of the artifact with the given checksum or not."""
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('test -d {}/{}'.format(get_release_store_dir(app_name), checksum))
+    return out.succeeded
+
+
+def read_file(file_path):
+    """Read the specified file in a single round-trip to the host.
+
+    Returns:
+        a string of the file's contents, or None if it can't be read
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('cat {}'.format(file_path))
+
+    if out.failed:
+        return None
+    return out.stdout
 
 
 def print_file(file_path):
-    """Prints the printable characters in the specified file."""
-    if files.exists(file_path):
-        sudo('strings -n 1 {}'.format(file_path))
-    else:
+    """Prints the specified file."""
+    contents = read_file(file_path)
+    if contents is None:
         print 'File not found: {}'.format(file_path)
+    else:
+        print contents
+
+
+def get_app_version(app_name):
+    """Get the contents of the current version dot txt file for the given
+    app_name, as a single line.
+
+    Returns:
+        a string representing the version, or None if there's no version file
+    """
+    contents = read_file('{}/current/version.txt'.format(get_app_basedir(app_name)))
+    if contents is None:
+        return None
+    return ' | '.join(line.strip() for line in contents.splitlines() if line.strip())
 
 
 def print_app_version(app_name):
@@ -54,6 +389,13 @@ def delete_temp_dir(app_name):
     sudo('rm -rf /tmp/.fab-deploy-{}'.format(app_name))
 
 
+def prepare_temp_dir(app_name):
+    """Create an empty temp directory for the app on the remote host, owned by
+    the connecting user."""
+    sudo('rm -rf {0} && mkdir -p {0} && chown {1} {0}'.format(get_temp_dir(app_name),
+                                                              env['user']))
+
+
 def upload_build_artifact(filename, app_name):
     """Upload the build artifact from the localhost and place in the temp
     directory of the remote host.
@@ -65,74 +407,422 @@ def upload_build_artifact(filename, app_name):
     temp_dir = get_temp_dir(app_name)
 
     # pre-clean and setup the remote upload directory
-    sudo('rm -rf {}'.format(temp_dir))
-    sudo('mkdir -p {}'.format(temp_dir))
-    sudo('chown {} {}'.format(env['user'], temp_dir))
+    prepare_temp_dir(app_name)
 
     # upload build artifact to host's temp_dir
-    put(filename, temp_dir, mode=664)
+    with timing.span('upload', bytes=path.getsize(filename)):
+        put(filename, temp_dir, mode=664)
+
+
+def get_decompress_command(artifact, source=''):
+    """Get the shell command that decompresses `artifact` to a tar stream.
+
+    Args:
+        artifact: the artifact's filename, used to pick the codec
+        source: (optional) the path to read from. (default=stdin)
+
+    Returns:
+        a string representing the decompression command
+    """
+    for (extensions, command) in ARTIFACT_DECOMPRESSORS:
+        if artifact.endswith(extensions):
+            return command.format(source).strip()
+    # anything else is assumed to be gzipped, as it always has been
+    return ARTIFACT_DECOMPRESSORS[0][1].format(source).strip()
+
+
+def get_run_as_owner_command(owner):
+    """Get the command prefix that runs a command as the user (and group) in
+    `owner`. Files are extracted this way so that they're written with the
+    right ownership in the first place, rather than chowned afterwards. It
+    uses `sudo`, which deploys need anyway, since `runuser -u` is missing
+    from older util-linux releases.
+
+    Args:
+        owner: the desired user:group (or user) ownership
+
+    Returns:
+        a string representing the command prefix
+    """
+    (user, _, group) = owner.partition(':')
+    if group:
+        return 'sudo -n -u {} -g {} --'.format(user, group)
+    return 'sudo -n -u {} --'.format(user)
+
+
+def get_artifact_transfer(transfer=None, artifact=None):
+    """Get the artifact transfer mode, see `DEFAULT_ARTIFACT_TRANSFER`.
+
+    Args:
+        transfer: (optional) The transfer mode, instead of the configured one.
+        artifact: (optional) The artifact being transferred; delta transfers
+                  fall back to upload for formats they can't read.
+    """
+    transfer = transfer or env.get('artifact_transfer', DEFAULT_ARTIFACT_TRANSFER)
+    if transfer not in ('upload', 'stream', 'delta', 'fanout'):
+        raise Exception('Unknown artifact transfer mode [{}]!'.format(transfer))
+    if transfer == 'delta' and artifact and not delta.can_read_artifact(artifact):
+        return 'upload'
+    return transfer
+
+
+def get_pool_size(num_hosts=None):
+    """Get the max number of hosts to run a parallel step on at once, see
+    `DEFAULT_POOL_SIZE`.
+
+    Args:
+        num_hosts: (optional) The number of hosts the step runs on, if fewer
+                   workers than the pool size are needed.
+    """
+    pool_size = int(env.get('pool_size') or DEFAULT_POOL_SIZE)
+    if num_hosts is not None:
+        pool_size = max(1, min(pool_size, num_hosts))
+    return pool_size
+
+
+def __parse_release_output(stdout):
+    """Get the dict of `RELEASE key=value` lines printed by a release script."""
+    result = {}
+    for line in stdout.splitlines():
+        if line.startswith('RELEASE '):
+            (key, val) = line[len('RELEASE '):].split('=', 1)
+            result[key] = val
+    return result
+
+
+def run_release_script(script, phase='release'):
+    """Run a release script on the remote host as a single `sudo` call.
+
+    The script reports what it did by printing `RELEASE key=value` lines.
+
+    Args:
+        script: the shell script to run
+        phase: (optional) the name the run is timed under
+
+    Returns:
+        a dict of the reported keys and values
+    """
+    with settings(warn_only=True), timing.span(phase):
+        out = sudo(script)
+
+    if out.failed:
+        raise Exception('Release script failed with status [{}]: {}'.format(
+            out.return_code, out.stdout.splitlines()[-1:]))
 
+    return __parse_release_output(out.stdout)
 
-def deploy_artifact(app_name, artifact_uri, owner=DEFAULT_OWNER):
+
+def stream_release_script(script, filename, phase='release'):
+    """Run a release script on the remote host as root, with the local file
+    `filename` streamed into its stdin over the host's SSH connection.
+
+    Args:
+        script: the shell script to run
+        filename: the local file to stream
+        phase: (optional) the name the run is timed under
+
+    Returns:
+        a dict of the reported keys and values
+    """
+    # make sure fabric has connected, then open a raw channel on its transport
+    sudo('true')
+    start = time()
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.set_combine_stderr(True)
+    channel.exec_command('sudo -n bash -c {}'.format(pipes.quote(script)))
+
+    try:
+        with open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(STREAM_CHUNK_SIZE), b''):
+                channel.sendall(chunk)
+        channel.shutdown_write()
+    except (socket.error, EOFError):
+        # the script exited without reading all of its input; its exit
+        # status below says whether that was a failure
+        pass
+
+    stdout = []
+    for chunk in iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b''):
+        stdout.append(chunk)
+    stdout = b''.join(stdout)
+    status = channel.recv_exit_status()
+    channel.close()
+    timing.record(phase, start, time(), streamed=True, failed=status != 0)
+
+    if status != 0:
+        raise Exception('Release script failed with status [{}]: {}'.format(
+            status, stdout.splitlines()[-1:]))
+
+    return __parse_release_output(stdout)
+
+
+def build_delta_release(app_name, artifact_uri, owner=DEFAULT_OWNER):
+    """Build the new release in the staging release directory, uploading only
+    the files that the host's current and previous releases don't already
+    have (by content and mode, as listed in the manifests they were built
+    with), and hardlinking the rest from them.
+
+    Args:
+        app_name: The name of the app to be deployed.
+        artifact_uri: The path to the local artifact to be deployed.
+        owner: (optional) The desired user:group ownership of the
+               deployed files.
+
+    Returns:
+        a dict with the number of files `linked` and `transferred`
+    """
+    artifact = path.basename(artifact_uri)
+    vhost_dir = get_app_basedir(app_name)
+    temp_dir = get_temp_dir(app_name)
+    staging_dir = get_staging_release_dir(app_name)
+
+    with hide('stdout'), timing.span('delta_manifest'):
+        out = sudo(MANIFEST_SCRIPT.format(
+            current_sym='{}/current'.format(vhost_dir),
+            curr_dir=get_current_release_dir(app_name),
+            prev_dir='{}/releases/prev'.format(vhost_dir),
+            manifest=delta.DELTA_MANIFEST))
+    (release_dirs, remote_manifests) = delta.parse_remote_manifests(out.stdout)
+    manifest = delta.get_artifact_manifest(artifact)
+    links = delta.plan_delta(manifest, remote_manifests,
+                             [r for r in ('curr', 'prev') if r in release_dirs])
+
+    work_dir = mkdtemp()
+    try:
+        delta_artifact = path.join(work_dir, 'delta.tar.gz')
+        (num_files, num_bytes) = delta.write_delta_artifact(artifact, links, delta_artifact)
+        upload_build_artifact(delta_artifact, app_name)
+        manifest_file = path.join(work_dir, delta.DELTA_MANIFEST)
+        delta.write_manifest(manifest, manifest_file)
+        put(manifest_file, temp_dir)
+
+        link_commands = []
+        for (release, names) in links.items():
+            if not names:
+                continue
+            link_list = path.join(work_dir, delta.DELTA_LINK_LISTS[release])
+            delta.write_link_list(names, link_list)
+            put(link_list, temp_dir)
+            link_commands.append('(cd {} && {} xargs -0 -r cp -al --parents -t {}/) < {}/{}'.format(
+                release_dirs[release], get_run_as_owner_command(owner), staging_dir, temp_dir,
+                delta.DELTA_LINK_LISTS[release]))
+    finally:
+        shutil.rmtree(work_dir)
+
+    run_release_script(DELTA_SCRIPT.format(
+        staging_dir=staging_dir,
+        temp_dir=temp_dir,
+        manifest=delta.DELTA_MANIFEST,
+        link_commands='\n'.join(link_commands),
+        decompress=get_decompress_command('delta.tar.gz', '{}/delta.tar.gz'.format(temp_dir)),
+        as_owner=get_run_as_owner_command(owner),
+        owner=owner), phase='delta_build')
+
+    num_linked = sum(len(names) for names in links.values())
+    print 'Delta release: [{}] files linked, [{}] files ([{}] bytes) transferred.'.format(
+        num_linked, num_files, num_bytes)
+
+    return {'linked': num_linked, 'transferred': num_files}
+
+
+def stage_artifact(app_name, artifact_uri, extract=False, owner=DEFAULT_OWNER, transfer=None):
+    """Upload the deployable to the targeted host ahead of deployment, so
+    that `deploy_artifact` doesn't have to while the host is out of service.
+
+    Args:
+        app_name: The name of the app to be deployed.
+        artifact_uri: The path to the local artifact to be uploaded.
+        extract: (optional) Also extract the artifact into the staging
+                 release directory. Streamed artifacts always are.
+        owner: (optional) The desired user:group ownership of the
+               extracted files.
+        transfer: (optional) The artifact transfer mode. Delta transfers
+                  always build the release in the staging directory. With
+                  fanout, the artifact must have been distributed already.
+    """
+    artifact = path.basename(artifact_uri)
+    temp_dir = get_temp_dir(app_name)
+    transfer = get_artifact_transfer(transfer, artifact)
+
+    if is_release_store_enabled() and \
+            is_in_release_store(app_name, artifacts.get_artifact_checksum(artifact)):
+        print 'Release is in the release store already, nothing to stage.'
+        return {'store_hit': '1'}
+
+    if transfer == 'delta':
+        return build_delta_release(app_name, artifact_uri, owner)
+
+    # a streamed artifact is only ever extracted, straight into the staging dir
+    stream = transfer == 'stream'
+    extract = extract or stream
+
+    if stream:
+        decompress = get_decompress_command(artifact)
+    else:
+        decompress = get_decompress_command(artifact, '{}/{}'.format(temp_dir, artifact))
+
+    script = STAGE_SCRIPT.format(
+        staging_dir=get_staging_release_dir(app_name),
+        extract=int(bool(extract)),
+        decompress=decompress,
+        as_owner=get_run_as_owner_command(owner),
+        owner=owner)
+
+    if stream:
+        return stream_release_script(script, artifact, phase='stage_extract')
+
+    if transfer != 'fanout':
+        upload_build_artifact(artifact, app_name)
+    return run_release_script(script, phase='stage_extract')
+
+
+def deploy_artifact(app_name, artifact_uri, owner=DEFAULT_OWNER, staged=False, transfer=None):
     """Upload the deployable to the targeted host.
 
+    The release rotation runs as a single remote script; see `RELEASE_SCRIPT`,
+    or `STORE_RELEASE_SCRIPT` if the release store is enabled. A release the
+    host's store already has isn't transferred at all.
+
     Args:
         app_name: The name of the app to be deployed.
         artifact_uri: The path to the local artifact to be uploaded/deployed.
         owner: (optional) The desired user:group ownership of the
                deployed files.
+        staged: (optional) The artifact was already pushed to the host by
+                `stage_artifact`, so skip the upload.
+        transfer: (optional) The artifact transfer mode, see
+                  `DEFAULT_ARTIFACT_TRANSFER`.
+
+    Returns:
+        a dict with the `deploy_dir` the release went into, and whether the
+        old release was `rotated` to prev and the new one `pre_extracted`
+        (and with the release store, whether it was a `store_hit`)
     """
     artifact = path.basename(artifact_uri)
+    vhost_dir = get_app_basedir(app_name)
+    temp_dir = get_temp_dir(app_name)
+    transfer = get_artifact_transfer(transfer, artifact)
+
+    # a release the host's store has already needs nothing transferred
+    store = is_release_store_enabled()
+    if store:
+        checksum = artifacts.get_artifact_checksum(artifact)
+        if not staged and is_in_release_store(app_name, checksum):
+            staged = True
+
+    # a delta release is built in the staging dir, then rotated in as if staged
+    if not staged and transfer == 'delta':
+        build_delta_release(app_name, artifact_uri, owner)
+        staged = True
+
+    stream = not staged and transfer == 'stream'
+
+    if stream:
+        decompress = get_decompress_command(artifact)
+    else:
+        decompress = get_decompress_command(artifact, '{}/{}'.format(temp_dir, artifact))
+
+    script_args = dict(
+        temp_dir=temp_dir,
+        decompress=decompress,
+        current_sym='{}/current'.format(vhost_dir),
+        curr_dir=get_current_release_dir(app_name),
+        prev_dir='{}/releases/prev'.format(vhost_dir),
+        staging_dir=get_staging_release_dir(app_name),
+        staged=int(bool(staged)),
+        as_owner=get_run_as_owner_command(owner),
+        owner=owner)
+
+    if store:
+        script = STORE_RELEASE_SCRIPT.format(store_dir=get_release_store_dir(app_name),
+                                             checksum=checksum,
+                                             retention=RELEASE_STORE['retention'],
+                                             **script_args)
+    else:
+        script = RELEASE_SCRIPT.format(**script_args)
+
+    if stream:
+        return stream_release_script(script, artifact)
+
+    if not staged:
+        upload_build_artifact(artifact, app_name)
+    return run_release_script(script)
+
+
+def __get_rollback_script(app_name, dry_run=False):
+    """Get the `ROLLBACK_SCRIPT` for the given app_name."""
+    vhost_dir = get_app_basedir(app_name)
+    return ROLLBACK_SCRIPT.format(
+        current_sym='{}/current'.format(vhost_dir),
+        curr_dir=get_current_release_dir(app_name),
+        prev_dir='{}/releases/prev'.format(vhost_dir),
+        dry_run=int(bool(dry_run)))
 
-    upload_build_artifact(artifact, app_name)
 
-    with cd(get_temp_dir(app_name)):
-        # handle apps that use the 'current' symlink.
-        vhost_dir = get_app_basedir(app_name)
-        deploy_dir = get_current_release_dir(app_name)
-        current_sym = '{}/current'.format(vhost_dir)
+def get_rollback_target(app_name):
+    """Get the release directory that `rollback_release` would switch to.
 
-        # If a 'current' symlink exists, find out what it points to
-        # and rotate it to 'prev'. If current is not a symlink, return
-        # an error.
-        if files.exists(current_sym):
-            if files.is_link(current_sym):
-                deploy_dir = sudo('readlink {}'.format(current_sym)).stdout
-            else:
-                raise Exception('[{}] is not a symlink?!?'.format(current_sym))
+    Returns:
+        a string representing the release directory, or None if there's
+        no release to roll back to
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo(__get_rollback_script(app_name, dry_run=True))
+
+    if out.failed:
+        return None
+    return __parse_release_output(out.stdout).get('deploy_dir')
 
-        # delete 'prev' release directory and rotate 'curr' to 'prev'
-        # (only if 'current' wasn't pointing to 'prev')
-        prev_dir = '{}/releases/prev'.format(vhost_dir)
-        if deploy_dir != prev_dir:
-            sudo('rm -rf {}'.format(prev_dir))
-            if files.exists(deploy_dir):
-                sudo('mv {} {}'.format(deploy_dir, prev_dir))
 
-        # now, deploy new version into the 'curr' release directory
-        sudo('mkdir -pv {}'.format(deploy_dir))
-        sudo('tar -C {}/ -xzf {}'.format(deploy_dir, artifact))
+def rollback_release(app_name):
+    """Switch the app back to the release before the current one, without
+    transferring or extracting anything; see `ROLLBACK_SCRIPT`.
+
+    Returns:
+        a dict with the `deploy_dir` now current, and the release it was
+        `rolled_back_from`
+    """
+    result = run_release_script(__get_rollback_script(app_name), phase='rollback')
+    print 'Rolled back from [{rolled_back_from}] to [{deploy_dir}].'.format(**result)
+    return result
 
-        # it's possible 'current' isn't pointing at 'curr', so let's
-        # fix it to point there now
-        sudo('rm -fv {}'.format(current_sym))
-        sudo('ln -svf {} {}'.format(deploy_dir, current_sym))
 
-        # fix up file ownership on newly-deployed files
-        sudo('chown -R {} {}'.format(owner, deploy_dir))
+def stage_go_app(app_name, uri, extract=False):
+    """Common staging recipe for Go applications.
 
-    delete_temp_dir(app_name)
+    Args:
+        app_name: the name of the Go application.
+        uri: the build artifact URI.
+        extract: (optional) also pre-extract the release on the host.
+    """
+    run_steps([
+        Step('fetch', local_fetch_s3_artifact, uri),
+        Step('stage', stage_artifact, app_name, uri, extract=extract, requires=['fetch']),
+    ])
 
 
-def deploy_go_app(app_name, uri):
+def deploy_go_app(app_name, uri, staged=False):
     """Common deployment recipe for Go applications.
 
     Args:
         app_name: the name of the Go application.
         uri: the build artifact URI.
+        staged: (optional) the artifact was already staged by `stage_go_app`.
+    """
+    run_steps([
+        Step('fetch', local_fetch_s3_artifact, uri),
+        Step('release', deploy_artifact, app_name, uri, staged=staged, requires=['fetch']),
+        Step('config', create_symlink,
+             '{}/config/config.yaml'.format(get_app_basedir(app_name)),
+             '{}/current/etc/config.yaml'.format(get_app_basedir(app_name)),
+             requires=['release']),
+    ])
+
+
+def rollback_go_app(app_name):
+    """Common rollback recipe for Go applications.
+
+    Args:
+        app_name: the name of the Go application.
     """
-    execute(local_fetch_s3_artifact, uri)
-    execute(deploy_artifact, app_name, uri)
-    execute(create_symlink,
-            '{}/config/config.yaml'.format(get_app_basedir(app_name)),
-            '{}/etc/config.yaml'.format(get_current_release_dir(app_name)))
+    execute(rollback_release, app_name)
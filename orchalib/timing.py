@@ -0,0 +1,205 @@
+"""Per-phase timing of deploys, written out as a JSON run timeline"""
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+from threading import Lock, local
+from time import time
+
+from fabric.api import env
+
+
+# opt-in recording of spans for the current run (see `start_run`)
+TIMELINE = {
+    'dir': None,
+    'name': None,
+    'started': None,
+    'spans_file': None,
+}
+
+# serializes span writes from threads in the same process; writes from
+# forked fabric workers are separate appends of whole lines to the file
+__WRITE_LOCK = Lock()
+
+# per-thread stack of AWS API call start times, for botocore versions that
+# don't pass a request context to event handlers (see `instrument_client`)
+__API_CALLS = local()
+
+
+def start_run(name, timeline_dir):
+    """Starts recording spans for a run. Spans recorded by forked parallel
+    workers are collected too, since they share the spans file.
+
+    Args:
+        name: A name for the run, i.e. the task and app.
+        timeline_dir: The directory to write the spans and timeline to.
+    """
+    timeline_dir = os.path.expanduser(timeline_dir)
+    if not os.path.isdir(timeline_dir):
+        os.makedirs(timeline_dir)
+
+    TIMELINE['dir'] = timeline_dir
+    TIMELINE['name'] = name
+    TIMELINE['started'] = time()
+    TIMELINE['spans_file'] = os.path.join(
+        timeline_dir, '.{}-{}-{}.spans'.format(name, int(TIMELINE['started']), os.getpid()))
+    open(TIMELINE['spans_file'], 'w').close()
+
+
+def is_recording():
+    """Returns boolean indicating spans are being recorded or not."""
+    return TIMELINE['spans_file'] is not None
+
+
+def record(phase, start, end, host=None, **attrs):
+    """Records a span that has already finished.
+
+    Args:
+        phase: The name of the phase, i.e. 'upload'.
+        start: The span's start time, in seconds since the epoch.
+        end: The span's end time, in seconds since the epoch.
+        host: (optional) The host the span applies to. (default=the current host)
+        attrs: (optional) Extra fields to record with the span.
+    """
+    if not is_recording():
+        return
+
+    entry = dict(attrs)
+    entry.update({
+        'phase': phase,
+        'host': host if host is not None else env.get('host_string'),
+        'start': start,
+        'end': end,
+        'duration': end - start,
+        'pid': os.getpid(),
+    })
+    with __WRITE_LOCK:
+        with open(TIMELINE['spans_file'], 'a') as spans:
+            spans.write(json.dumps(entry) + '\n')
+
+
+@contextmanager
+def span(phase, host=None, **attrs):
+    """Context manager that records how long its body takes as a span.
+    Spans that raise are recorded with `failed` set."""
+    start = time()
+    try:
+        yield
+    except BaseException:
+        record(phase, start, time(), host, failed=True, **attrs)
+        raise
+    record(phase, start, time(), host, **attrs)
+
+
+def timed(phase):
+    """Decorator that records each call of the function as a span."""
+    def decorator(func):
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+def __before_api_call(context=None, **_):
+    """botocore `before-call` handler, noting when an API call started."""
+    if context is not None:
+        context['deploytool_start'] = time()
+        return
+    if not hasattr(__API_CALLS, 'starts'):
+        __API_CALLS.starts = []
+    __API_CALLS.starts.append(time())
+
+
+def __after_api_call(model=None, context=None, **_):
+    """botocore `after-call` handler, recording the API call as a span."""
+    if context is not None and 'deploytool_start' in context:
+        start = context.pop('deploytool_start')
+    elif getattr(__API_CALLS, 'starts', None):
+        start = __API_CALLS.starts.pop()
+    else:
+        return
+    record('aws_api', start, time(), host='localhost',
+           operation='{}.{}'.format(model.service_model.service_name, model.name))
+
+
+def instrument_client(client):
+    """Records every API call made through a boto3 client, with its latency."""
+    client.meta.events.register('before-call', __before_api_call)
+    client.meta.events.register('after-call', __after_api_call)
+    return client
+
+
+def __percentile(values, percent):
+    """Returns the nearest-rank percentile of a sorted list of values."""
+    index = max(0, int(-(-len(values) * percent // 100)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(spans):
+    """Returns a list of per-phase (and per-API operation) summary dicts."""
+    durations = {}
+    for entry in spans:
+        key = entry['phase']
+        if key == 'aws_api':
+            key = 'aws:{}'.format(entry['operation'])
+        durations.setdefault(key, []).append(entry['duration'])
+
+    summary = []
+    for (key, values) in sorted(durations.items()):
+        values.sort()
+        summary.append({
+            'phase': key,
+            'count': len(values),
+            'total': sum(values),
+            'p50': __percentile(values, 50),
+            'p95': __percentile(values, 95),
+            'max': values[-1],
+        })
+    return summary
+
+
+def finish_run():
+    """Stops recording, writes the run's JSON timeline, and prints a summary
+    table of the phases.
+
+    Returns:
+        a string representing path to the timeline, or None if not recording
+    """
+    if not is_recording():
+        return None
+
+    spans = []
+    with open(TIMELINE['spans_file'], 'r') as spans_file:
+        for line in spans_file:
+            if line.strip():
+                spans.append(json.loads(line))
+    os.remove(TIMELINE['spans_file'])
+    spans.sort(key=lambda entry: entry['start'])
+
+    finished = time()
+    summary = summarize(spans)
+    timeline_file = os.path.join(TIMELINE['dir'], '{}-{}.json'.format(
+        TIMELINE['name'], int(TIMELINE['started'])))
+    with open(timeline_file, 'w') as timeline:
+        json.dump({
+            'run': TIMELINE['name'],
+            'started': TIMELINE['started'],
+            'finished': finished,
+            'duration': finished - TIMELINE['started'],
+            'summary': summary,
+            'spans': spans,
+        }, timeline, indent=2)
+
+    print '{:<40} {:>6} {:>9} {:>8} {:>8} {:>8}'.format('phase', 'count', 'total', 'p50',
+                                                        'p95', 'max')
+    for row in summary:
+        print '{phase:<40} {count:>6} {total:>8.2f}s {p50:>7.2f}s {p95:>7.2f}s {max:>7.2f}s'.format(
+            **row)
+    print 'Run took [{:.1f}] seconds. Timeline written to [{}].'.format(
+        finished - TIMELINE['started'], timeline_file)
+
+    TIMELINE['spans_file'] = None
+    return timeline_file
@@ -1,5 +1,8 @@
-"""deploytool recipes"""
-import recipes.demoapp
+"""deploytool recipes
+
+Recipes are imported on demand by `orchalib.registry`, one per app, so they
+aren't imported here.
+"""
 
 # hide subtasks defined in recipes
 __all__ = []
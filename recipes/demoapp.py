@@ -3,8 +3,15 @@
 from fabric.api import execute
 from fabric.decorators import task
 
-from orchalib import get_current_release_dir, get_app_basedir
+from orchalib import get_app_basedir
 from orchalib import tasks
+from orchalib.steps import Step, run_steps
+
+
+# URL probed on each instance after a deploy or restart, before it goes back
+# into its ELBs, with `{ip}` in place of the instance's IP, i.e.
+# 'http://{ip}:8080/health'. None relies on the ELB health checks alone.
+HEALTH_CHECK_URL = None
 
 
 @task
@@ -13,6 +20,12 @@ def print_app_version():
     execute(tasks.print_app_version, 'demoapp')
 
 
+@task
+def get_app_version():
+    """Get the currently deployed version info for the app."""
+    return tasks.get_app_version('demoapp')
+
+
 @task
 def service_restart():
     """Restart services for this app."""
@@ -20,21 +33,50 @@ def service_restart():
 
 
 @task
-def deploy(uri=None, **_):
+def stage(uri=None, extract=False):
+    """Push the demoapp artifact to the host ahead of the ELB rotation.
+
+    Args:
+        uri: The S3 URI for the application artifact to be staged.
+        extract: Also pre-extract the release on the host.
+    """
+    assert uri is not None
+
+    run_steps([
+        Step('fetch', tasks.local_fetch_s3_artifact, uri),
+        Step('stage', tasks.stage_artifact, 'demoapp', uri, extract=extract,
+             requires=['fetch']),
+    ])
+
+
+@task
+def deploy(uri=None, staged=False, **_):
     """Deploy demoapp.
 
     Args:
         uri: The S3 URI for the application artifact to be deployed.
+        staged: The artifact was already pushed to the host by `stage`.
     """
     assert uri is not None
 
     app_name = 'demoapp'
     config_dir = '{}/config'.format(get_app_basedir(app_name))
-    release_dir = get_current_release_dir(app_name)
-
-    execute(tasks.local_fetch_s3_artifact, uri)
-    execute(tasks.deploy_artifact, app_name, uri)
-    execute(tasks.create_symlink,
-            '{}/config.yml'.format(config_dir),
-            '{}/config.yml'.format(release_dir))
-    execute(tasks.service_restart, app_name)
+    release_dir = '{}/current'.format(get_app_basedir(app_name))
+
+    run_steps([
+        Step('fetch', tasks.local_fetch_s3_artifact, uri),
+        Step('release', tasks.deploy_artifact, app_name, uri, staged=staged,
+             requires=['fetch']),
+        Step('config', tasks.create_symlink,
+             '{}/config.yml'.format(config_dir),
+             '{}/config.yml'.format(release_dir),
+             requires=['release']),
+        Step('restart', tasks.service_restart, app_name, requires=['config']),
+    ])
+
+
+@task
+def rollback():
+    """Roll demoapp back to its previous release, and restart it."""
+    execute(tasks.rollback_release, 'demoapp')
+    execute(tasks.service_restart, 'demoapp')
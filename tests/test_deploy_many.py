@@ -0,0 +1,173 @@
+"""Runs `deploy_many` against a stubbed inventory, with the timeline enabled"""
+
+import glob
+import json
+import os
+import shutil
+import time
+import unittest
+from tempfile import mkdtemp
+
+from fabric.api import env
+
+import fabfile
+from orchalib import aws
+from orchalib import registry
+from orchalib import tasks
+from orchalib.models.aws import Ec2Instance, Ec2InstanceCollection
+
+
+class Recipe(object):
+    """A recipe whose deploys are appended to a log file, so that deploys run
+    in forked processes can be read back."""
+
+    def __init__(self, name, log_file):
+        self.name = name
+        self.log_file = log_file
+
+    def deploy(self, uri=None, **_):
+        # long enough for deploys that run at the same time to overlap
+        time.sleep(0.1)
+        log_event(self.log_file, 'deploy', self.name, env.host_string, uri)
+
+
+class Health(object):
+    healthy = True
+
+
+def log_event(log_file, *event):
+    """Appends an event, with the time it happened, to a log file."""
+    with open(log_file, 'a') as log:
+        log.write(json.dumps([time.time()] + list(event)) + '\n')
+
+
+def read_events(log_file):
+    """Returns the events in a log file, in the order they happened."""
+    with open(log_file) as log:
+        return sorted(json.loads(line) for line in log if line.strip())
+
+
+class DeployManyTestCase(unittest.TestCase):
+    """Runs `deploy_many` from a scratch directory with a `config.yml`, against
+    instances given as a dict of instance id -> apps and ELBs given as a dict
+    of app -> ELB names. ELB (de)registrations and deploys go to a log file."""
+
+    instances = {}
+    elbs = {}
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.log_file = os.path.join(self.root, 'events.log')
+        self.timeline_dir = os.path.join(self.root, 'timelines')
+        with open(os.path.join(self.root, 'config.yml'), 'w') as cfg:
+            cfg.write('timeline:\n    dir: {}\n'.format(self.timeline_dir))
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+
+        inventory = Ec2InstanceCollection([
+            Ec2Instance(instance_id, '10.0.0.{}'.format(num + 1),
+                        [{'Key': 'Apps', 'Value': ','.join(apps)}])
+            for (num, (instance_id, apps)) in enumerate(sorted(self.instances.items()))])
+        elb_index = {('prd', app): names for (app, names) in self.elbs.items()}
+
+        self.patch(aws, 'get_elb_index', lambda refresh=False: elb_index)
+        self.patch(aws, 'get_instances', lambda **_: inventory)
+        self.patch(aws, 'remove_instances_from_elb_map', self.remove_instances)
+        self.patch(aws, 'add_instances_to_elb_map', self.add_instances)
+        self.patch(tasks, 'local_fetch_s3_artifact', lambda uri: None)
+        self.patch(registry, 'load_recipe', lambda name: Recipe(name, self.log_file))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        env.pop('timeline_dir', None)
+        shutil.rmtree(self.root)
+
+    def patch(self, module, name, value):
+        """Replaces a module's attribute for the rest of the test."""
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def remove_instances(self, elb_map):
+        for (elb, instance_ids) in sorted(elb_map.items()):
+            for instance_id in instance_ids:
+                log_event(self.log_file, 'remove', elb, instance_id)
+
+    def add_instances(self, elb_map):
+        results = []
+        for (elb, instance_ids) in sorted(elb_map.items()):
+            for instance_id in instance_ids:
+                log_event(self.log_file, 'add', elb, instance_id)
+                results.append(Health())
+        return results
+
+    def write_manifest(self, manifest):
+        """Writes a manifest to a file in a subdirectory, and returns its path."""
+        os.makedirs(os.path.join(self.root, 'manifests'))
+        manifest_file = os.path.join(self.root, 'manifests', 'release.json')
+        with open(manifest_file, 'w') as dest:
+            json.dump(manifest, dest)
+        return manifest_file
+
+    def deploy_many(self, *args, **kwargs):
+        """Runs `deploy_many`, which is otherwise only run once per process."""
+        if hasattr(fabfile.deploy_many.wrapped, 'return_value'):
+            del fabfile.deploy_many.wrapped.return_value
+        return fabfile.deploy_many(*args, **kwargs)
+
+
+class DeployManyTest(DeployManyTestCase):
+
+    instances = {'i-1': ['api', 'worker'], 'i-2': ['api'], 'i-3': ['web']}
+    elbs = {'api': ['elb-api'], 'web': ['elb-web']}
+
+    def test_deploy_many_from_a_manifest_file_writes_a_timeline(self):
+        manifest_file = self.write_manifest({
+            'api': 's3://artifacts/api.tgz',
+            'worker': 's3://artifacts/worker.tgz',
+            'web': 's3://artifacts/web.tgz'})
+
+        self.deploy_many(manifest_file, 'prd', stage='none')
+
+        deploys = [event[1:] for event in read_events(self.log_file) if event[1] == 'deploy']
+        self.assertEqual(sorted(deploys), [
+            ['deploy', 'api', '10.0.0.1', 's3://artifacts/api.tgz'],
+            ['deploy', 'api', '10.0.0.2', 's3://artifacts/api.tgz'],
+            ['deploy', 'web', '10.0.0.3', 's3://artifacts/web.tgz'],
+            ['deploy', 'worker', '10.0.0.1', 's3://artifacts/worker.tgz']])
+
+        self.assertEqual(glob.glob(os.path.join(self.timeline_dir, '.*.spans')), [])
+        timelines = glob.glob(os.path.join(self.timeline_dir, '*.json'))
+        self.assertEqual(len(timelines), 1)
+        with open(timelines[0]) as timeline_file:
+            timeline = json.load(timeline_file)
+        self.assertTrue(timeline['run'].startswith('deploy_many-'))
+        self.assertTrue(timeline['run'].endswith('manifests_release.json-prd'))
+        # the waves of both groups of apps, recorded in their forked processes
+        self.assertEqual(len([s for s in timeline['spans'] if s['phase'] == 'wave']), 3)
+
+
+class DeploySharedElbTest(DeployManyTestCase):
+
+    instances = {'i-1': ['api'], 'i-2': ['api'], 'i-3': ['admin'], 'i-4': ['admin']}
+    elbs = {'api': ['elb-shared'], 'admin': ['elb-shared']}
+
+    def test_apps_behind_the_same_elb_stay_within_max_unavailable(self):
+        self.deploy_many(json.dumps({
+            'api': 's3://artifacts/api.tgz',
+            'admin': 's3://artifacts/admin.tgz'}), 'prd', max_unavailable='1', stage='none')
+
+        out_of_service = {'elb-shared': set()}
+        most_out_of_service = 0
+        for (_, action, elb, instance_id) in [event for event in read_events(self.log_file)
+                                              if event[1] in ('remove', 'add')]:
+            if action == 'remove':
+                out_of_service[elb].add(instance_id)
+            else:
+                out_of_service[elb].discard(instance_id)
+            most_out_of_service = max(most_out_of_service, len(out_of_service[elb]))
+        self.assertEqual(most_out_of_service, 1)
+        self.assertEqual(out_of_service, {'elb-shared': set()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+"""Runs the release rotation scripts against a scratch directory with bash"""
+
+import grp
+import os
+import pwd
+import shutil
+import subprocess
+import tarfile
+import unittest
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from fabric.api import settings
+
+from orchalib import delta
+from orchalib import tasks
+
+
+class ReleaseScriptTestCase(unittest.TestCase):
+    """Deploys and rolls back releases of files with given contents, with the
+    app's basedir, staging and temp dirs in a scratch directory."""
+
+    def setUp(self):
+        self.root = mkdtemp()
+        os.makedirs(os.path.join(self.root, 'releases'))
+        self.paths = dict(
+            current_sym=os.path.join(self.root, 'current'),
+            curr_dir=os.path.join(self.root, 'releases', 'curr'),
+            prev_dir=os.path.join(self.root, 'releases', 'prev'),
+            staging_dir=os.path.join(self.root, 'releases', 'next'),
+            temp_dir=os.path.join(self.root, 'tmp'))
+        self.store_dir = os.path.join(self.root, 'releases', 'store')
+        self.owner = '{}:{}'.format(pwd.getpwuid(os.getuid()).pw_name,
+                                    grp.getgrgid(os.getgid()).gr_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_output(self, script):
+        """Runs a script, and returns its output."""
+        proc = subprocess.Popen(['bash', '-c', script], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        stdout = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, stdout)
+        return stdout
+
+    def run_script(self, script):
+        """Runs a release script, and returns its `RELEASE key=value` lines as a dict."""
+        return dict(line[len('RELEASE '):].split('=', 1)
+                    for line in self.run_output(script).splitlines()
+                    if line.startswith('RELEASE '))
+
+    def write_artifact(self, files):
+        """Writes an artifact of `files`, a dict of path -> contents, to the temp dir."""
+        if not os.path.isdir(self.paths['temp_dir']):
+            os.makedirs(self.paths['temp_dir'])
+        artifact = os.path.join(self.paths['temp_dir'], 'app.tgz')
+        with tarfile.open(artifact, 'w:gz') as tar:
+            for (name, contents) in sorted(files.items()):
+                info = tarfile.TarInfo(name)
+                info.size = len(contents)
+                tar.addfile(info, StringIO(contents))
+        return artifact
+
+    def stage_delta(self, files, link_from):
+        """Builds a release of `files` in the staging dir the way a delta
+        release is: files `link_from` has with the same contents are
+        hardlinked from it, and the rest are written."""
+        staging_dir = self.paths['staging_dir']
+        os.makedirs(staging_dir)
+        for (name, contents) in files.items():
+            linked = os.path.join(link_from, name)
+            if os.path.isfile(linked) and open(linked).read() == contents:
+                os.link(linked, os.path.join(staging_dir, name))
+            else:
+                with open(os.path.join(staging_dir, name), 'w') as dest:
+                    dest.write(contents)
+
+    def delta_stage(self, files):
+        """Builds a release of `files` in the staging dir with `DELTA_SCRIPT`, the
+        way a delta transfer plans it from the manifests the host reports, and
+        returns the paths that were hardlinked."""
+        artifact = self.write_artifact(files)
+        manifest = delta.get_artifact_manifest(artifact)
+        (release_dirs, remote_manifests) = delta.parse_remote_manifests(
+            self.run_output(tasks.MANIFEST_SCRIPT.format(
+                current_sym=self.paths['current_sym'], curr_dir=self.paths['curr_dir'],
+                prev_dir=self.paths['prev_dir'], manifest=delta.DELTA_MANIFEST)))
+        links = delta.plan_delta(manifest, remote_manifests,
+                                 [r for r in ('curr', 'prev') if r in release_dirs])
+
+        delta_artifact = os.path.join(self.paths['temp_dir'], 'delta.tar.gz')
+        delta.write_delta_artifact(artifact, links, delta_artifact)
+        delta.write_manifest(manifest, os.path.join(self.paths['temp_dir'],
+                                                    delta.DELTA_MANIFEST))
+        link_commands = []
+        for (release, names) in links.items():
+            if names:
+                link_list = os.path.join(self.paths['temp_dir'], delta.DELTA_LINK_LISTS[release])
+                delta.write_link_list(names, link_list)
+                link_commands.append('(cd {} && xargs -0 -r cp -al --parents -t {}/) < {}'.format(
+                    release_dirs[release], self.paths['staging_dir'], link_list))
+        self.run_script(tasks.DELTA_SCRIPT.format(
+            staging_dir=self.paths['staging_dir'], temp_dir=self.paths['temp_dir'],
+            manifest=delta.DELTA_MANIFEST, link_commands='\n'.join(link_commands),
+            decompress=tasks.get_decompress_command('delta.tar.gz', delta_artifact),
+            as_owner='', owner=self.owner))
+        return sorted(name for names in links.values() for name in names)
+
+    def deploy(self, files=None, staged=False):
+        """Deploys a release of `files`, or the release in the staging dir if `staged`."""
+        if not staged:
+            artifact = self.write_artifact(files)
+        return self.run_script(tasks.RELEASE_SCRIPT.format(
+            decompress=tasks.get_decompress_command('app.tgz', artifact if not staged else ''),
+            staged=int(staged), as_owner='', owner=self.owner, **self.paths))
+
+    def store_deploy(self, files, checksum, retention=5):
+        """Deploys a release of `files` into the release store, as the artifact
+        with `checksum`."""
+        artifact = self.write_artifact(files)
+        return self.run_script(tasks.STORE_RELEASE_SCRIPT.format(
+            decompress=tasks.get_decompress_command('app.tgz', artifact),
+            store_dir=self.store_dir, checksum=checksum, retention=retention,
+            staged=0, as_owner='', owner=self.owner, **self.paths))
+
+    def stored(self):
+        """Returns the names of the releases in the store."""
+        return sorted(name for name in os.listdir(self.store_dir) if not name.startswith('.'))
+
+    def link(self, name):
+        """Returns where a symlink in the app's basedir points."""
+        return os.readlink(os.path.join(self.root, name))
+
+    def rollback(self):
+        """Rolls back to the previous release."""
+        return self.run_script(tasks.ROLLBACK_SCRIPT.format(
+            dry_run=0, current_sym=self.paths['current_sym'],
+            curr_dir=self.paths['curr_dir'], prev_dir=self.paths['prev_dir']))
+
+    def read(self, name, release='current'):
+        """Returns the contents of a file in a release, or None if it doesn't exist."""
+        filename = os.path.join(self.root, release, name)
+        if not os.path.exists(filename):
+            return None
+        return open(filename).read()
+
+
+class ReleaseScriptTest(ReleaseScriptTestCase):
+
+    def test_deploy_rotates_curr_to_prev(self):
+        self.deploy({'version.txt': 'v1'})
+        result = self.deploy({'version.txt': 'v2'})
+
+        self.assertEqual(result['deploy_dir'], self.paths['curr_dir'])
+        self.assertEqual(result['rotated'], '1')
+        self.assertEqual(self.read('version.txt'), 'v2')
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v1')
+
+    def test_deploy_replaces_release_instead_of_overlaying_it(self):
+        self.deploy({'version.txt': 'v1', 'old.txt': 'v1'})
+        self.deploy({'version.txt': 'v2'})
+
+        self.assertEqual(self.read('old.txt'), None)
+
+    def test_staged_delta_release_never_writes_through_hardlinks(self):
+        self.deploy({'version.txt': 'v1', 'shared.txt': 'same'})
+        self.stage_delta({'version.txt': 'v2', 'shared.txt': 'same'},
+                         self.paths['curr_dir'])
+        self.deploy(staged=True)
+        self.rollback()
+
+        # `current` is at the v1 release in prev, which shares shared.txt with curr
+        self.stage_delta({'version.txt': 'v3', 'shared.txt': 'same'},
+                         self.paths['prev_dir'])
+        self.deploy(staged=True)
+
+        self.assertEqual(self.read('version.txt'), 'v3')
+        self.assertEqual(self.read('shared.txt'), 'same')
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v1')
+        self.assertEqual(self.read('shared.txt', 'releases/prev'), 'same')
+
+    def test_deploy_after_rollback_keeps_the_release_rolled_back_to(self):
+        self.deploy({'version.txt': 'v1', 'good.txt': 'v1'})
+        self.deploy({'version.txt': 'v2', 'bad.txt': 'v2'})
+        self.assertEqual(self.rollback()['deploy_dir'], self.paths['prev_dir'])
+
+        result = self.deploy({'version.txt': 'v3'})
+        self.assertEqual(result['deploy_dir'], self.paths['curr_dir'])
+        self.assertEqual(result['rotated'], '0')
+        self.assertEqual(self.read('version.txt'), 'v3')
+        self.assertEqual(self.read('bad.txt'), None)
+        self.assertEqual(self.read('good.txt', 'releases/prev'), 'v1')
+
+        # rolling back again goes to the known-good release, not the rolled-back one
+        self.assertEqual(self.rollback()['deploy_dir'], self.paths['prev_dir'])
+        self.assertEqual(self.read('version.txt'), 'v1')
+        self.assertEqual(self.read('good.txt'), 'v1')
+
+
+
+class StoreReleaseScriptTest(ReleaseScriptTestCase):
+
+    def test_store_hit_switches_to_the_kept_release(self):
+        self.store_deploy({'version.txt': 'v1'}, 'aaa')
+        self.store_deploy({'version.txt': 'v2'}, 'bbb')
+        result = self.store_deploy({'version.txt': 'changed'}, 'aaa')
+
+        self.assertEqual(result['store_hit'], '1')
+        self.assertEqual(result['rotated'], '1')
+        self.assertEqual(self.link('current'), os.path.join(self.store_dir, 'aaa'))
+        self.assertEqual(self.link('releases/prev'), os.path.join(self.store_dir, 'bbb'))
+        self.assertEqual(self.read('version.txt'), 'v1')
+
+    def test_pruning_spares_current_and_prev(self):
+        self.store_deploy({'version.txt': 'v1'}, 'aaa', retention=1)
+        self.store_deploy({'version.txt': 'v2'}, 'bbb', retention=1)
+        result = self.store_deploy({'version.txt': 'v3'}, 'ccc', retention=1)
+        self.assertEqual(result['pruned'], '1')
+        self.assertEqual(self.stored(), ['bbb', 'ccc'])
+
+        # after a rollback, `prev` is at the most recently deployed release
+        self.rollback()
+        self.store_deploy({'version.txt': 'v4'}, 'ddd', retention=1)
+        self.assertEqual(self.stored(), ['bbb', 'ddd'])
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v2')
+
+    def test_rollback_swaps_current_and_prev(self):
+        self.store_deploy({'version.txt': 'v1'}, 'aaa')
+        self.store_deploy({'version.txt': 'v2'}, 'bbb')
+
+        self.assertEqual(self.rollback()['deploy_dir'], os.path.join(self.store_dir, 'aaa'))
+        self.assertEqual(self.read('version.txt'), 'v1')
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v2')
+
+        self.assertEqual(self.rollback()['deploy_dir'], os.path.join(self.store_dir, 'bbb'))
+        self.assertEqual(self.read('version.txt'), 'v2')
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v1')
+
+    def test_enabling_the_store_keeps_the_release_it_replaces(self):
+        self.deploy({'version.txt': 'v1'})
+        self.deploy({'version.txt': 'v2'})
+        self.store_deploy({'version.txt': 'v3'}, 'ccc')
+
+        self.assertEqual(self.read('version.txt'), 'v3')
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v2')
+        self.assertEqual(self.rollback()['deploy_dir'], self.link('current'))
+        self.assertEqual(self.read('version.txt'), 'v2')
+
+    def test_enabling_the_store_after_a_rollback_keeps_the_release_rolled_back_to(self):
+        self.deploy({'version.txt': 'v1'})
+        self.deploy({'version.txt': 'v2'})
+        self.rollback()
+        self.store_deploy({'version.txt': 'v3'}, 'ccc')
+
+        self.assertEqual(self.read('version.txt'), 'v3')
+        self.assertTrue(self.link('releases/prev').startswith(self.store_dir))
+        self.assertEqual(self.read('version.txt', 'releases/prev'), 'v1')
+
+        self.rollback()
+        self.assertEqual(self.read('version.txt'), 'v1')
+
+
+
+class DeltaReleaseScriptTest(ReleaseScriptTestCase):
+
+    def test_delta_is_planned_from_the_manifests_releases_were_built_with(self):
+        self.assertEqual(self.delta_stage({'version.txt': 'v1', 'shared.txt': 'same'}), [])
+        self.deploy(staged=True)
+        self.assertIsNotNone(self.read(delta.DELTA_MANIFEST, 'releases/curr'))
+
+        linked = self.delta_stage({'version.txt': 'v2', 'shared.txt': 'same'})
+        self.deploy(staged=True)
+
+        self.assertEqual(linked, ['./shared.txt'])
+        self.assertEqual(self.read('version.txt'), 'v2')
+        self.assertEqual(self.read('shared.txt'), 'same')
+
+    def test_delta_links_nothing_from_a_release_without_a_manifest(self):
+        self.deploy({'version.txt': 'v1', 'shared.txt': 'same'})
+
+        self.assertEqual(self.delta_stage({'version.txt': 'v2', 'shared.txt': 'same'}), [])
+        self.deploy(staged=True)
+        self.assertEqual(self.read('shared.txt'), 'same')
+
+    def test_formats_delta_cannot_read_are_uploaded(self):
+        with settings(artifact_transfer='delta'):
+            self.assertEqual(tasks.get_artifact_transfer(artifact='app.tar.zst'), 'upload')
+            self.assertEqual(tasks.get_artifact_transfer(artifact='app.tar.xz'), 'upload')
+            self.assertEqual(tasks.get_artifact_transfer(artifact='app.tgz'), 'delta')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""Checks the fabfile's load time against the budget in bench/startup_time.py"""
+
+import imp
+import os
+import unittest
+
+startup_time = imp.load_source('startup_time', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'startup_time.py'))
+
+# fresh interpreters per measurement, of which the best is taken
+REPEATS = 5
+
+
+class StartupTimeTest(unittest.TestCase):
+
+    def test_fabfile_loads_within_budget(self):
+        (fabric_ms, _, _) = startup_time.time_import('import fabric.api, paramiko', REPEATS)
+        (fabfile_ms, _, _) = startup_time.time_import('import fabfile', REPEATS)
+
+        self.assertLess(fabfile_ms - fabric_ms, startup_time.MAX_MS)
+
+    def test_fabfile_loads_no_lazy_modules_or_recipes(self):
+        (_, loaded, recipes) = startup_time.time_import('import fabfile', 1)
+
+        self.assertEqual(loaded, [])
+        self.assertEqual(recipes, [])
+
+    def test_loading_a_recipe_loads_no_other_recipes(self):
+        (_, _, recipes) = startup_time.time_import(
+            'import fabfile\nfrom orchalib import registry\nregistry.load_recipe("demoapp")', 1)
+
+        self.assertEqual(recipes, ['recipes.demoapp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
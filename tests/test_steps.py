@@ -0,0 +1,91 @@
+"""Tests for running recipe steps in dependency order"""
+
+import os
+import time
+import unittest
+
+from fabric.api import env, settings
+
+from orchalib.steps import Step, run_steps
+
+
+def sleep_and_report(seconds):
+    """Sleeps, and returns the process it ran in and when it started and ended."""
+    start = time.time()
+    time.sleep(seconds)
+    return (os.getpid(), start, time.time())
+
+
+def set_host_string(host_string, seconds):
+    """Changes fabric's `env` for a while, and returns what it was set to."""
+    with settings(host_string=host_string):
+        time.sleep(seconds)
+        return env.host_string
+
+
+def read_host_string(seconds):
+    """Returns the value of fabric's `env.host_string` after a while."""
+    time.sleep(seconds)
+    return env.host_string
+
+
+def fail():
+    """Always raises."""
+    raise ValueError('step failed')
+
+
+class RunStepsTest(unittest.TestCase):
+
+    def test_independent_steps_run_concurrently_in_separate_processes(self):
+        start = time.time()
+        results = run_steps([
+            Step('a', sleep_and_report, 0.5),
+            Step('b', sleep_and_report, 0.5),
+        ])
+
+        self.assertLess(time.time() - start, 0.9)
+        (pid_a, start_a, end_a) = results['a']
+        (pid_b, start_b, end_b) = results['b']
+        self.assertLess(max(start_a, start_b), min(end_a, end_b))
+        self.assertNotEqual(pid_a, pid_b)
+        self.assertNotIn(os.getpid(), (pid_a, pid_b))
+
+    def test_concurrent_steps_do_not_share_fabric_env(self):
+        with settings(host_string='10.0.0.1'):
+            results = run_steps([
+                Step('set', set_host_string, '10.0.0.2', 0.5),
+                Step('read', read_host_string, 0.2),
+            ])
+            self.assertEqual(env.host_string, '10.0.0.1')
+
+        self.assertEqual(results['set'], '10.0.0.2')
+        self.assertEqual(results['read'], '10.0.0.1')
+
+    def test_chained_steps_run_in_order_in_this_process(self):
+        results = run_steps([
+            Step('second', sleep_and_report, 0, requires=['first']),
+            Step('first', sleep_and_report, 0),
+        ])
+
+        self.assertEqual(results['first'][0], os.getpid())
+        self.assertEqual(results['second'][0], os.getpid())
+        self.assertLessEqual(results['first'][2], results['second'][1])
+
+    def test_failure_is_reraised_and_stops_later_steps(self):
+        with self.assertRaises(ValueError):
+            run_steps([
+                Step('fail', fail),
+                Step('slow', sleep_and_report, 0.2),
+                Step('after', sleep_and_report, 0, requires=['fail']),
+            ])
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(Exception):
+            run_steps([
+                Step('a', fail, requires=['b']),
+                Step('b', fail, requires=['a']),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()